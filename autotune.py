@@ -0,0 +1,172 @@
+'''
+Finds the resource settings with the best throughput on this host and saves them as the
+runtime profile (see runtime.py), which the pipeline loads at startup.
+
+Usage:
+    python autotune.py --model parameters.pt --count 4 -o runtime_profile.json
+
+The pipeline runs on synthetic boards (see benchmark.render_corpus) under every candidate,
+one setting at a time:
+    1. torch threads, then OpenCV threads, for one process converting one board at a time,
+    2. the number of squares per forward pass of evaluate_many,
+    3. the number of worker processes, each with an equal share of the cores, as batch.py
+       runs them.
+'''
+from benchmark import render_corpus
+from inference import BACKENDS, MODEL_PATH, InferenceSession, get_session
+from png2fen import evaluate, evaluate_many
+from runtime import PROFILE_PATH, apply_threads, apply_worker_threads, default_config, save_profile
+
+import argparse
+import os
+import platform
+import sys
+from multiprocessing import get_context
+from time import perf_counter, strftime
+
+
+BATCH_SIZES = (64, 128, 256, 512, 1024)
+
+_worker_options = {}
+
+
+def thread_candidates(cpus):
+    """
+    Powers of two up to the number of cores, and the number of cores itself.
+    """
+    candidates = {cpus}
+    threads = 1
+    while threads < cpus:
+        candidates.add(threads)
+        threads *= 2
+    return sorted(candidates)
+
+
+def throughput(convert, images, warmup=2):
+    """
+    :param convert: callable converting the list of images.
+    :return: boards per second.
+    """
+    convert(images[:warmup])
+    start = perf_counter()
+    convert(images)
+    return len(images) / (perf_counter() - start)
+
+
+def tune_threads(images, session, cpus, log):
+    """
+    :return: ({'torch_threads': n, 'cv2_threads': n}, {setting: {threads: boards per second}})
+    """
+    def convert(batch):
+        for img in batch:
+            evaluate(img, session=session)
+
+    best = {'torch_threads': cpus, 'cv2_threads': cpus}
+    measurements = {}
+    for setting in ('torch_threads', 'cv2_threads'):
+        measurements[setting] = {}
+        for threads in thread_candidates(cpus):
+            apply_threads(**{**best, setting: threads})
+            measurements[setting][threads] = throughput(convert, images)
+            log('%s=%d: %.1f boards/s' % (setting, threads, measurements[setting][threads]))
+        best[setting] = max(measurements[setting], key=measurements[setting].get)
+    apply_threads(**best)
+    return best, measurements
+
+
+def tune_batch_size(images, session, log, candidates=BATCH_SIZES):
+    """
+    :return: (max_batch_size, {max_batch_size: boards per second})
+    """
+    measurements = {}
+    for batch_size in candidates:
+        measurements[batch_size] = throughput(
+            lambda batch: evaluate_many(batch, max_batch_size=batch_size, session=session), images)
+        log('max_batch_size=%d: %.1f boards/s' % (batch_size, measurements[batch_size]))
+    return max(measurements, key=measurements.get), measurements
+
+
+def _init_worker(model_path, backend, threads, warmup, ready):
+    apply_worker_threads(threads)
+    _worker_options.update(model_path=model_path, backend=backend)
+    # Load the model and run it once before the timing starts
+    _convert(warmup)
+    ready.put(True)
+
+
+def _convert(img):
+    return evaluate(img, session=get_session(_worker_options['model_path'], _worker_options['backend']))
+
+
+def tune_workers(images, model_path, backend, cpus, log):
+    """
+    :return: (workers, threads per worker, {workers: boards per second})
+    """
+    # Forking after OpenCV and torch have run their thread pools can deadlock the workers
+    context = get_context('spawn')
+    measurements = {}
+    for workers in thread_candidates(cpus):
+        threads = max(1, cpus // workers)
+        # At least a few boards per worker, so that every worker is busy for the whole pass
+        corpus = images * -(-4 * workers // len(images))
+        ready = context.Queue()
+        with context.Pool(workers, initializer=_init_worker,
+                          initargs=(model_path, backend, threads, images[0], ready)) as pool:
+            for _ in range(workers):
+                ready.get()
+            measurements[workers] = throughput(lambda batch: pool.map(_convert, batch, chunksize=1), corpus,
+                                               warmup=0)
+        log('workers=%d (%d threads each): %.1f boards/s' % (workers, threads, measurements[workers]))
+    workers = max(measurements, key=measurements.get)
+    return workers, max(1, cpus // workers), measurements
+
+
+def autotune(model_path=MODEL_PATH, backend='eager', count=4, seed=0, cpus=None, workers=True, log=None):
+    """
+    :param count: boards per theme and square size of the synthetic corpus.
+    :param workers: bool. also tune the number of worker processes (the slowest step).
+    :return: (config, measurements)
+    """
+    log = log or (lambda line: None)
+    cpus = cpus or os.cpu_count() or 1
+    config = default_config(cpus)
+    images = [image for _, _, _, image in render_corpus(count, square_sizes=(40, 60), seed=seed)]
+    session = InferenceSession(model_path, backend=backend)
+
+    threads, measurements = tune_threads(images, session, cpus, log)
+    config.update(threads)
+    config['max_batch_size'], measurements['max_batch_size'] = tune_batch_size(images, session, log)
+    if workers:
+        config['workers'], config['worker_threads'], measurements['workers'] = tune_workers(
+            images, model_path, backend, cpus, log)
+    return config, measurements
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Tune the threads, workers and batch size for this host.')
+    parser.add_argument('--model', default=MODEL_PATH, help='path to the model parameters')
+    parser.add_argument('--backend', default='eager', choices=BACKENDS)
+    parser.add_argument('--count', type=int, default=4, help='boards per theme and square size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cpus', type=int, default=None, help='cores to plan for (default: all)')
+    parser.add_argument('--no-workers', action='store_true', help='skip tuning the worker processes')
+    parser.add_argument('-o', '--output', default=PROFILE_PATH, help='the profile file to write')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    def log(line):
+        print(line, file=sys.stderr)
+
+    config, measurements = autotune(args.model, args.backend, args.count, args.seed, args.cpus,
+                                    not args.no_workers, log)
+    save_profile(config, args.output, measurements=measurements,
+                 host={'cpus': args.cpus or os.cpu_count(), 'machine': platform.machine(),
+                       'date': strftime('%Y-%m-%dT%H:%M:%S')})
+    log('saved %s: %s' % (args.output, config))
+
+
+if __name__ == '__main__':
+    main()
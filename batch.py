@@ -0,0 +1,194 @@
+'''
+Headless batch conversion of board images to fen.
+
+Usage:
+    python batch.py diagrams/ 'scans/**/*.png' board.jpg -o fens.jsonl --workers 4
+
+Every input image produces one JSON line with its path, fen, timings (in seconds) and
+error (null on success). With --page, every image is a page that may hold several diagrams,
+and the record holds a list of boards, each with its fen and bounding box, instead of a
+single fen. Lines are written as soon as results arrive, so the order of the
+output does not follow the order of the inputs. With --resume, images that already have a
+successful record in the output file are skipped and new records are appended.
+
+torch and OpenCV are imported only once there is something to convert, before the workers
+are forked, so that they share the loaded modules.
+'''
+from cache import ResultCache
+from runtime import BACKENDS, apply_worker_threads, get_config, preload
+from tracing import span
+
+import argparse
+import glob
+import json
+import os
+import sys
+from multiprocessing import Pool
+from time import time
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+_worker_options = {}
+_worker_cache = None
+
+
+def collect_paths(inputs, extensions=IMAGE_EXTENSIONS):
+    """
+    Expands files, directories (recursively) and glob patterns to a sorted list of image paths.
+    """
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.update(os.path.join(root, f) for f in files if f.lower().endswith(extensions))
+        elif os.path.isfile(item):
+            paths.add(item)
+        else:
+            paths.update(p for p in glob.glob(item, recursive=True)
+                         if os.path.isfile(p) and p.lower().endswith(extensions))
+    return sorted(paths)
+
+
+def completed_paths(output):
+    """
+    The paths that already have a successful record in an existing output file.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if (record.get('fen') or record.get('boards') is not None) and not record.get('error'):
+                done.add(record['path'])
+    return done
+
+
+def _init_worker(options):
+    global _worker_cache
+    apply_worker_threads(options['threads'])
+    _worker_options.update(options)
+    if options.get('cache_size'):
+        _worker_cache = ResultCache(max_size=options['cache_size'])
+
+
+def convert(path):
+    """
+    Decodes and recognizes a single image. Never raises; failures are reported in the record.
+    """
+    import cv2
+    from inference import get_session
+    from png2fen import evaluate, evaluate_page
+    record = {'path': path, 'fen': None, 'timings': {}, 'error': None}
+    start = time()
+    try:
+        with span('decode', path=path) as s:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError('could not decode image')
+            s.set(image=img.shape[:2])
+        record['timings']['decode'] = time() - start
+
+        session = get_session(_worker_options['model_path'], _worker_options['backend'])
+        recognize_start = time()
+        if _worker_options.get('page'):
+            record['boards'] = [{'fen': board['fen'], 'bbox': [int(v) for v in board['bbox']]}
+                                for board in evaluate_page(img, resizing=_worker_options['resizing'],
+                                                           session=session,
+                                                           detection=_worker_options['detection'])]
+        else:
+            record['fen'] = evaluate(img, resizing=_worker_options['resizing'], session=session,
+                                     detection=_worker_options['detection'], cache=_worker_cache)
+        record['timings']['recognize'] = time() - recognize_start
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    record['timings']['total'] = time() - start
+    return record
+
+
+def run(paths, output, workers=1, chunk_size=4, options=None):
+    """
+    Converts the paths and streams the records to the output file object.
+    :param workers: number of worker processes. 0 converts in the current process.
+    :return: (number of converted images, number of failures)
+    """
+    count, failures = 0, 0
+    if workers == 0:
+        _init_worker(options)
+        results = map(convert, paths)
+        pool = None
+    else:
+        pool = Pool(workers, initializer=_init_worker, initargs=(options,))
+        results = pool.imap_unordered(convert, paths, chunksize=chunk_size)
+    try:
+        for record in results:
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            count += 1
+            failures += record['error'] is not None
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return count, failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert board images to fen, one JSON line per image.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='-', help='output JSONL file (default: stdout)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, 0 to run in-process '
+                             '(default: from the runtime profile, see runtime.py)')
+    parser.add_argument('--chunk-size', type=int, default=4, help='images handed to a worker at a time')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='OpenCV and torch threads per worker (default: from the runtime profile)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip images that already succeeded in the output file and append to it')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='results remembered per worker to skip duplicate images, 0 to disable')
+    parser.add_argument('--model', default='parameters.pt', help='path to the model parameters')
+    parser.add_argument('--backend', default='eager', choices=BACKENDS, help='inference backend')
+    parser.add_argument('--resizing', type=int, default=350, help='see png2fen.evaluate')
+    parser.add_argument('--detection', default='auto', choices=('auto', 'grid', 'ss'),
+                        help='region detection mode (see png2fen.board_regions)')
+    parser.add_argument('--page', action='store_true',
+                        help='find and convert every diagram on each image, e.g. scanned book pages')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.resume and args.output == '-':
+        sys.exit('--resume requires an output file')
+
+    paths = collect_paths(args.inputs)
+    if args.resume:
+        done = completed_paths(args.output)
+        paths = [p for p in paths if p not in done]
+    if paths:
+        preload()
+
+    config = get_config()
+    workers = config['workers'] if args.workers is None else args.workers
+    threads = args.threads
+    if threads is None:
+        threads = config['worker_threads'] if workers else config['torch_threads']
+    options = {'model_path': args.model, 'backend': args.backend, 'resizing': args.resizing,
+               'detection': args.detection, 'threads': threads, 'cache_size': args.cache_size,
+               'page': args.page}
+    start = time()
+    if args.output == '-':
+        count, failures = run(paths, sys.stdout, workers, args.chunk_size, options)
+    else:
+        with open(args.output, 'a' if args.resume else 'w') as output:
+            count, failures = run(paths, output, workers, args.chunk_size, options)
+    print('converted %d images (%d failed) in %.2f seconds' % (count, failures, time() - start),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
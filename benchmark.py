@@ -0,0 +1,382 @@
+'''
+Stage-level latency and accuracy benchmark on synthetic boards.
+
+Usage:
+    python benchmark.py --count 200 --square-sizes 30 40 60 80 -o bench.json
+    python benchmark.py --candidates model32.pt model48.pt parameters.pt --min-accuracy 0.995
+
+Random positions are rendered with fen2png.DrawBoard on both board themes and at several
+square sizes. Every stage of png2fen.evaluate (resize, region detection, square extraction,
+inference and fen assembly) is timed separately for every board. The report holds the
+p50/p95/p99 latencies in milliseconds, the throughput and the recognition accuracy, as
+json, so that reports of different versions can be compared. The accuracy of the two stages
+of the classification cascade (the empty square gate and the model) is reported apart.
+
+With --candidates, models trained at different square sizes are compared instead, and the
+cheapest one that meets --min-accuracy is selected (see cheapest_model).
+
+With --pages, evaluate_page is run on pages of captioned diagrams, and the report holds the
+fraction of the boards found at the right place and recognized.
+
+With --margins, only the grid detection is checked, on boards that span from the whole image
+down to half of it (see render_margin_corpus), and the report holds the fraction of the boards
+located within a quarter square for every board span.
+
+With --startup, the time a fresh interpreter takes to import each entry point is measured
+against STARTUP_BUDGET instead, along with the heavy modules the import pulled in. The exit
+status is 1 if an entry point is over its budget.
+'''
+from board import Board
+from fen2png import DrawBoard
+from inference import BACKENDS, MODEL_PATH, InferenceSession
+import png2fen
+
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import torch
+from time import perf_counter, strftime
+
+
+STAGES = ('resize', 'regions', 'squares', 'inference', 'fen')
+# Seconds an entry point may take to import, i.e. before the tray icon shows or the
+# arguments are parsed. The pipeline (HEAVY_MODULES) is imported later, when it's needed.
+STARTUP_BUDGET = {'main': 0.3, 'batch': 0.15, 'server': 0.15}
+HEAVY_MODULES = ('numpy', 'cv2', 'torch')
+
+
+def random_fen(rng, min_empty=0.4, max_empty=0.95):
+    """
+    A random position (not necessarily legal), with a random fraction of empty squares.
+    """
+    empty = rng.uniform(min_empty, max_empty)
+    labels = [0 if rng.random_sample() < empty else rng.randint(1, len(png2fen.LABELS_LIST))
+              for _ in range(64)]
+    return png2fen.labels2fen(labels)
+
+
+def fen2labels(fen):
+    return Board.from_fen(fen).labels()
+
+
+def render_corpus(count, themes=('w', 'b'), square_sizes=(30, 40, 60, 80), seed=0):
+    """
+    :return: list of (fen, theme, square_size, BGR image), count boards per theme and size.
+    """
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for theme in themes:
+        for square_size in square_sizes:
+            for _ in range(count):
+                fen = random_fen(rng)
+                image = DrawBoard(fen, boardtype=theme, square_size=square_size).boardArray()
+                corpus.append((fen, theme, square_size, image))
+    return corpus
+
+
+def render_margin_corpus(count, fractions=(1., 0.8, 0.6, 0.5), size=350, themes=('w', 'b'), seed=0):
+    """
+    Boards centered on a plain background, like a loose snip: the board spans the given
+    fraction of a size x size image.
+    :return: list of (fraction, image, expected (x0, y0, square size)).
+    """
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for fraction in fractions:
+        for i in range(count):
+            board = DrawBoard(random_fen(rng), boardtype=themes[i % len(themes)], square_size=40).boardArray()
+            side = int(round(fraction * size))
+            board = cv2.resize(board, (side, side), interpolation=cv2.INTER_AREA)
+            background = np.array(rng.randint(180, 256, size=3), dtype=np.uint8)
+            image = np.empty((size, size, 3), dtype=np.uint8)
+            image[:] = background
+            x0 = y0 = (size - side) // 2
+            image[y0:y0 + side, x0:x0 + side] = board
+            corpus.append((fraction, image, (x0, y0, side / 8)))
+    return corpus
+
+
+def detection_accuracy(corpus, mode='auto'):
+    """
+    The fraction of the boards of a render_margin_corpus whose grid corners png2fen.board_regions
+    finds within a quarter square, by board fraction.
+    """
+    hits = {}
+    for fraction, image, (x0, y0, square) in corpus:
+        regions = png2fen.board_regions(image, mode=mode)
+        corners = np.array([regions[0][:2], regions[63][:2] + regions[63][2:]], dtype=float)
+        expected = np.array([[x0, y0], [x0 + 8 * square, y0 + 8 * square]])
+        hits.setdefault(fraction, []).append(np.abs(corners - expected).max() <= square / 4)
+    return {fraction: float(np.mean(h)) for fraction, h in hits.items()}
+
+
+def render_pages(count, square_size=70, captions=True, seed=0):
+    """
+    Pages of 2x2 diagrams at random offsets, each with a caption line right under it, like a
+    book page.
+    :return: list of (BGR page, [((x, y, w, h), fen)]).
+    """
+    rng = np.random.RandomState(seed)
+    pages = []
+    for _ in range(count):
+        page = np.full((1800, 2400, 3), 255, dtype=np.uint8)
+        boards = []
+        for i in range(4):
+            fen = random_fen(rng)
+            image = DrawBoard(fen, boardtype='wb'[rng.randint(2)], square_size=square_size).boardArray()
+            height, width = image.shape[:2]
+            x = 150 + (i % 2) * 1150 + rng.randint(0, 200)
+            y = 100 + (i // 2) * 850 + rng.randint(0, 60)
+            page[y:y + height, x:x + width] = image
+            boards.append(((x, y, width, height), fen))
+            if captions:
+                cv2.putText(page, 'Diagram %d: White to play and win after 1.Nf5 gxf5 2.Qg3+' % (i + 1),
+                            (x + rng.randint(-20, 20), y + height + 60), cv2.FONT_HERSHEY_SIMPLEX, 2.5,
+                            (0, 0, 0), 5)
+        pages.append((page, boards))
+    return pages
+
+
+def run_page_benchmark(pages, session, resizing=350, detection='auto'):
+    """
+    Runs png2fen.evaluate_page on the pages. A board counts as found if a box is within a
+    sixteenth of its side of the true one.
+    """
+    found, correct, times = 0, 0, []
+    boards = sum(len(truth) for _, truth in pages)
+    for page, truth in pages:
+        start = perf_counter()
+        results = png2fen.evaluate_page(page, resizing=resizing, session=session, detection=detection)
+        times.append(perf_counter() - start)
+        for (x, y, w, h), fen in truth:
+            tolerance = max(w, h) / 16
+            matches = [r for r in results if max(abs(r['bbox'][0] - x), abs(r['bbox'][1] - y),
+                                                 abs(r['bbox'][2] - w), abs(r['bbox'][3] - h)) <= tolerance]
+            found += bool(matches)
+            correct += any(r['fen'] == fen for r in matches)
+    return {'total': summarize(times), 'boards': boards, 'found': found / boards, 'board_accuracy': correct / boards}
+
+
+def time_stages(img, session, resizing=350, detection='auto', dedup=True, cascade=True, stats=None):
+    """
+    Runs the evaluate pipeline stage by stage.
+    :param stats: optional dict, filled with the square counts (see png2fen.classify_squares)
+                  and, under 'gate', the squares the empty square gate labeled empty.
+    :return: (fen, {stage: seconds})
+    """
+    timings = {}
+    start = perf_counter()
+    resized = cv2.resize(img, (resizing, resizing))
+    timings['resize'] = perf_counter() - start
+
+    start = perf_counter()
+    regions = png2fen.board_regions(resized, mode=detection)
+    timings['regions'] = perf_counter() - start
+
+    start = perf_counter()
+    squares = png2fen.regions2squares(img, png2fen.scale_regions(regions, img.shape, resizing),
+                                      square_size=session.square_size, channels=session.channels)
+    timings['squares'] = perf_counter() - start
+
+    start = perf_counter()
+    labels = png2fen.classify_squares(squares, session, dedup=dedup, stats=stats, cascade=cascade)
+    timings['inference'] = perf_counter() - start
+    if stats is not None:
+        stats['gate'] = png2fen.empty_squares(squares) if cascade else np.zeros(64, dtype=bool)
+
+    start = perf_counter()
+    fen = png2fen.labels2fen(labels)
+    timings['fen'] = perf_counter() - start
+    return fen, timings
+
+
+def summarize(seconds):
+    ms = np.array(seconds) * 1000
+    return {'mean': float(ms.mean()), 'p50': float(np.percentile(ms, 50)),
+            'p95': float(np.percentile(ms, 95)), 'p99': float(np.percentile(ms, 99))}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(corpus, session, resizing=350, detection='auto', dedup=True, cascade=True, warmup=3):
+    for _, _, _, image in corpus[:warmup]:
+        time_stages(image, session, resizing, detection, dedup, cascade)
+
+    timings = {stage: [] for stage in STAGES + ('total',)}
+    groups = {}
+    correct_boards, correct_squares = 0, 0
+    gated, gated_correct, classified, classified_correct = 0, 0, 0, 0
+    start = perf_counter()
+    for fen, theme, square_size, image in corpus:
+        stats = {}
+        predicted, stage_timings = time_stages(image, session, resizing, detection, dedup, cascade, stats)
+        for stage, seconds in stage_timings.items():
+            timings[stage].append(seconds)
+        timings['total'].append(sum(stage_timings.values()))
+
+        hits = np.array(fen2labels(predicted)) == np.array(fen2labels(fen))
+        square_hits = int(hits.sum())
+        gated += int(stats['gate'].sum())
+        gated_correct += int(hits[stats['gate']].sum())
+        classified += int((~stats['gate']).sum())
+        classified_correct += int(hits[~stats['gate']].sum())
+        correct_squares += square_hits
+        correct_boards += predicted == fen
+        group = groups.setdefault('%s-%d' % (theme, square_size), {'boards': 0, 'correct_boards': 0,
+                                                                   'correct_squares': 0, 'total': []})
+        group['boards'] += 1
+        group['correct_boards'] += predicted == fen
+        group['correct_squares'] += square_hits
+        group['total'].append(timings['total'][-1])
+    elapsed = perf_counter() - start
+
+    return {
+        'stages': {stage: summarize(timings[stage]) for stage in STAGES},
+        'total': summarize(timings['total']),
+        'throughput': len(corpus) / elapsed,
+        'accuracy': {'board': correct_boards / len(corpus), 'square': correct_squares / (64 * len(corpus))},
+        'cascade': {'gated_fraction': gated / (64 * len(corpus)),
+                    'gate_accuracy': gated_correct / gated if gated else None,
+                    'model_accuracy': classified_correct / classified if classified else None},
+        'groups': {name: {'boards': g['boards'],
+                          'board_accuracy': g['correct_boards'] / g['boards'],
+                          'square_accuracy': g['correct_squares'] / (64 * g['boards']),
+                          'total': summarize(g['total'])}
+                   for name, g in groups.items()},
+    }
+
+
+def cheapest_model(model_paths, corpus, min_accuracy=0.99, backend='eager', **options):
+    """
+    The policy for the classification resolution. The cost of a forward pass grows with the
+    square area, so the models are tried from the smallest square size up, and the first one
+    whose square accuracy on the corpus reaches min_accuracy is chosen.
+    :param options: passed on to run_benchmark.
+    :return: (the chosen model path, or None if no model is accurate enough, {path: summary})
+    """
+    sessions = sorted((InferenceSession(path, backend=backend) for path in model_paths),
+                      key=lambda session: session.square_size)
+    summaries = {}
+    for session in sessions:
+        report = run_benchmark(corpus, session, **options)
+        summaries[session.model_path] = {'square_size': session.square_size, 'accuracy': report['accuracy'],
+                                         'total': report['total'], 'inference': report['stages']['inference']}
+        if report['accuracy']['square'] >= min_accuracy:
+            return session.model_path, summaries
+    return None, summaries
+
+
+def import_time(module, repeats=3):
+    """
+    Imports the module in fresh interpreters, with python -X importtime.
+    :return: (the median seconds, the HEAVY_MODULES that were imported with it)
+    """
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES)
+    times = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True,
+                                text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # Lines are 'import time: self [us] | cumulative [us] | name', the module itself is the last one
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1e6)
+    return float(np.median(times)), result.stdout.split()
+
+
+def startup_report(budget=STARTUP_BUDGET, repeats=3):
+    report = {}
+    for module, seconds in budget.items():
+        elapsed, heavy = import_time(module, repeats)
+        report[module] = {'seconds': elapsed, 'budget': seconds, 'within_budget': elapsed <= seconds,
+                          'heavy_modules': heavy}
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the recognition pipeline on synthetic boards.')
+    parser.add_argument('--count', type=int, default=50, help='boards per theme and square size')
+    parser.add_argument('--themes', nargs='+', default=['w', 'b'], choices=('w', 'b'))
+    parser.add_argument('--square-sizes', nargs='+', type=int, default=[30, 40, 60, 80])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', default=MODEL_PATH, help='path to the model parameters')
+    parser.add_argument('--backend', default='eager', choices=BACKENDS)
+    parser.add_argument('--resizing', type=int, default=350)
+    parser.add_argument('--detection', default='auto', choices=('auto', 'grid', 'ss'))
+    parser.add_argument('--no-dedup', action='store_true', help='classify every square')
+    parser.add_argument('--no-cascade', action='store_true', help='send empty squares through the model too')
+    parser.add_argument('--candidates', nargs='+', default=None,
+                        help='models trained at different square sizes to choose the cheapest from')
+    parser.add_argument('--min-accuracy', type=float, default=0.99,
+                        help='the square accuracy the chosen candidate must reach')
+    parser.add_argument('--pages', type=int, default=0,
+                        help='benchmark evaluate_page on this many captioned pages of 4 diagrams instead')
+    parser.add_argument('--margins', type=int, default=0,
+                        help='check the grid detection on this many boards per span in wide margins instead')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the import time of the entry points against STARTUP_BUDGET')
+    parser.add_argument('-o', '--output', default='-', help='json report file (default: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    corpus = [] if args.startup or args.pages or args.margins else render_corpus(args.count, args.themes, args.square_sizes, args.seed)
+    meta = {'date': strftime('%Y-%m-%dT%H:%M:%S'), 'revision': git_revision(),
+            'python': platform.python_version(), 'torch': torch.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'threads': torch.get_num_threads(),
+            'boards': len(corpus), 'settings': vars(args)}
+    if args.startup:
+        report = {'meta': meta, 'startup': startup_report()}
+        for module, entry in report['startup'].items():
+            print('%s: %.0f ms (budget %.0f ms)%s' % (
+                module, 1000 * entry['seconds'], 1000 * entry['budget'],
+                ', imports ' + ' '.join(entry['heavy_modules']) if entry['heavy_modules'] else ''), file=sys.stderr)
+    elif args.pages:
+        session = InferenceSession(args.model, backend=args.backend)
+        report = {'meta': meta, 'pages': run_page_benchmark(render_pages(args.pages, seed=args.seed), session,
+                                                              args.resizing, args.detection)}
+        print('boards found %.3f, board accuracy %.3f' % (report['pages']['found'],
+                                                          report['pages']['board_accuracy']), file=sys.stderr)
+    elif args.margins:
+        report = {'meta': meta, 'margins': detection_accuracy(render_margin_corpus(args.margins, seed=args.seed),
+                                                              args.detection)}
+        print(', '.join('span %.1f: %.3f' % item for item in report['margins'].items()), file=sys.stderr)
+    elif args.candidates:
+        chosen, summaries = cheapest_model(args.candidates, corpus, args.min_accuracy, args.backend,
+                                           resizing=args.resizing, detection=args.detection,
+                                           dedup=not args.no_dedup, cascade=not args.no_cascade)
+        report = {'meta': meta, 'selection': {'chosen': chosen, 'min_accuracy': args.min_accuracy,
+                                              'candidates': summaries}}
+        print('chosen: %s' % (chosen or 'none of the candidates is accurate enough'), file=sys.stderr)
+    else:
+        session = InferenceSession(args.model, backend=args.backend)
+        report = {'meta': meta, **run_benchmark(corpus, session, args.resizing, args.detection,
+                                                not args.no_dedup, not args.no_cascade)}
+    payload = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(payload)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+        if 'total' in report:
+            print('p50 %.1f ms, p99 %.1f ms, %.1f boards/s, board accuracy %.3f' % (
+                report['total']['p50'], report['total']['p99'], report['throughput'], report['accuracy']['board']),
+                  file=sys.stderr)
+    if 'startup' in report and not all(entry['within_budget'] for entry in report['startup'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
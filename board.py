@@ -0,0 +1,137 @@
+'''
+A compact 64-square board model.
+
+The position is kept as a bytearray of 64 fen letters, 'e' for empty squares, in fen order
+(the first rank of the fen, i.e. a8 for white's perspective, first). Encoding and decoding
+fen, flipping and mirroring are done with byte translations and precomputed index maps
+instead of re-slicing strings.
+'''
+import re
+
+
+EMPTY = ord('e')
+# Label index (see png2fen.LABELS_DICT) to fen letter
+LABEL_PIECES = 'erbnqkpRBNQKP'
+# Fen letter to piece sprite name (see fen2png.ICONS) and back
+PIECES = "RBNQKPrbnqkp"
+PIECES_DICT = {i: ("b" if i.islower() else "w") + i.lower() for i in PIECES}
+INV_PIECES_DICT = {vals: keys for keys, vals in PIECES_DICT.items()}
+INV_PIECES_DICT['e'] = 'e'
+
+_LABELS_TO_CELLS = bytes.maketrans(bytes(range(len(LABEL_PIECES))), LABEL_PIECES.encode())
+_CELLS_TO_LABELS = bytes.maketrans(LABEL_PIECES.encode(), bytes(range(len(LABEL_PIECES))))
+_EXPAND = {ord(str(n)): 'e' * n for n in range(1, 9)}
+_EMPTY_RUN = re.compile('e+')
+
+# Index maps: new cell i is taken from old cell MAP[i]
+FLIP_RANKS = [8 * (7 - i // 8) + i % 8 for i in range(64)]
+MIRROR_FILES = [8 * (i // 8) + 7 - i % 8 for i in range(64)]
+ROTATE = [63 - i for i in range(64)]
+
+
+def _compress_run(match):
+    return str(len(match.group()))
+
+
+class Board:
+    __slots__ = ('cells',)
+
+    def __init__(self, cells=None):
+        """
+        :param cells: 64 bytes of fen letters ('e' for empty). Defaults to an empty board.
+        """
+        self.cells = bytearray(cells) if cells is not None else bytearray(b'e' * 64)
+        if len(self.cells) != 64:
+            raise ValueError('a board has 64 squares, got %d' % len(self.cells))
+
+    @classmethod
+    def from_fen(cls, fen):
+        """
+        :param fen: a full fen or only its position part.
+        """
+        position = fen.split(None, 1)[0].translate(_EXPAND).replace('/', '')
+        if len(position) != 64:
+            raise ValueError('invalid fen position %r' % fen.split(None, 1)[0])
+        return cls(position.encode())
+
+    @classmethod
+    def from_labels(cls, labels):
+        """
+        :param labels: 64 label indices (see png2fen.LABELS_DICT), list or numpy array.
+        """
+        return cls(bytes(bytearray(int(label) for label in labels)).translate(_LABELS_TO_CELLS))
+
+    def to_fen(self):
+        """
+        :return: the position part of the fen.
+        """
+        return _EMPTY_RUN.sub(_compress_run, self.extended())
+
+    def extended(self):
+        """
+        :return: the position with every empty square written as 'e', ranks separated by '/'.
+        """
+        cells = self.cells.decode()
+        return '/'.join(cells[i:i + 8] for i in range(0, 64, 8))
+
+    def labels(self):
+        return list(bytes(self.cells).translate(_CELLS_TO_LABELS))
+
+    def ranks(self):
+        """
+        :return: 8x8 list of fen letters, '' for empty squares.
+        """
+        cells = self.cells.decode().replace('e', ' ')
+        return [[square.strip() for square in cells[i:i + 8]] for i in range(0, 64, 8)]
+
+    @staticmethod
+    def index(rank, file):
+        """
+        :param rank: row of the fen, 0 for the first rank written in the fen.
+        :param file: column, 0 for the first square of the rank.
+        """
+        return 8 * rank + file
+
+    def __getitem__(self, square):
+        if isinstance(square, tuple):
+            square = self.index(*square)
+        cell = self.cells[square]
+        return '' if cell == EMPTY else chr(cell)
+
+    def __setitem__(self, square, piece):
+        """
+        :param piece: fen letter, or '' / 'e' for an empty square.
+        """
+        if isinstance(square, tuple):
+            square = self.index(*square)
+        self.cells[square] = ord(piece) if piece else EMPTY
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and self.cells == other.cells
+
+    def __repr__(self):
+        return 'Board(%r)' % self.to_fen()
+
+    def remap(self, index_map):
+        return Board(bytes(map(self.cells.__getitem__, index_map)))
+
+    def flipped(self):
+        """
+        The ranks in reverse order (the board seen from the other side, files unchanged).
+        """
+        return self.remap(FLIP_RANKS)
+
+    def mirrored(self):
+        """
+        Every rank written backwards.
+        """
+        return self.remap(MIRROR_FILES)
+
+    def rotated(self):
+        """
+        The board turned by 180 degrees.
+        """
+        return Board(self.cells[::-1])
+
+    def copy(self):
+        return Board(self.cells)
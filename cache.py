@@ -0,0 +1,112 @@
+'''
+A content-addressed cache of recognition results.
+
+Results are keyed by a hash of the board pixels after the resizing step of png2fen.evaluate,
+together with everything else that changes the result (model weights, backend, square size
+and detection mode). Entries are evicted least recently used first once the cache holds
+max_size entries. If a path is given, the cache is loaded from it on construction and
+written back by save().
+'''
+from collections import OrderedDict
+
+import hashlib
+import json
+import os
+import threading
+
+
+class ResultCache:
+    def __init__(self, max_size=1024, path=None):
+        """
+        :param max_size: the maximal number of cached results.
+        :param path: optional json file to persist the cache to.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(pixels, *context):
+        """
+        :param pixels: the normalized (resized) image as a numpy array.
+        :param context: anything else the result depends on, e.g. the model fingerprint.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((pixels.shape, str(pixels.dtype)) + context).encode())
+        digest.update(pixels.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        :return: the cached {'fen': str, 'labels': list of 64 ints, 'regions': the 64 square rects
+                 or None}, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, fen, labels, regions=None):
+        entry = {'fen': fen, 'labels': [int(label) for label in labels],
+                 'regions': None if regions is None else [[int(v) for v in rect] for rect in regions]}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        with open(self.path) as f:
+            entries = json.load(f)
+        with self._lock:
+            self._entries = OrderedDict(list(entries.items())[-self.max_size:])
+
+    def save(self):
+        """
+        Writes the cache to its path, in LRU order, atomically.
+        """
+        if self.path is None:
+            raise ValueError('this cache has no path to save to')
+        with self._lock:
+            entries = dict(self._entries)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(max_size=1024, path=None):
+    """
+    Returns the process-wide cache, creating it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(max_size=max_size, path=path)
+        return _cache
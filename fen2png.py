@@ -1,14 +1,13 @@
 import os
+from functools import lru_cache
 
 from PIL import Image
 import numpy as np
 import cv2
 from PyQt5.QtGui import QImage, QPixmap
 
-PIECES = "RBNQKPrbnqkp"
-PIECES_DICT = {i: ("b" if i.islower() else "w") + i.lower() for i in PIECES}
-INV_PIECES_DICT = {vals: keys for keys, vals in PIECES_DICT.items()}
-INV_PIECES_DICT['e'] = 'e'
+from board import INV_PIECES_DICT, PIECES, PIECES_DICT, Board
+
 ICONS = "resources/pieces/"
 
 
@@ -24,6 +23,24 @@ def is_int(val):
         return False
 
 
+def fen_positions(fen):
+    """
+    :return: 8x8 list of the fen's pieces ('' for empty squares), first rank of the fen first.
+    """
+    return Board.from_fen(fen).ranks()
+
+
+@lru_cache(maxsize=256)
+def load_sprite(path, size):
+    """
+    Decodes and scales an asset once per process. The image is shared between all the boards,
+    so copy it before drawing on it.
+    :param path: path of the png (the board theme or the piece is part of the name).
+    :param size: (width, height) to scale to.
+    """
+    return Image.open(path).resize(size)
+
+
 class DrawBoard:
     def __init__(self, fen, boardtype ='w', square_size=40):
         self.dir = os.getcwd() + '/'
@@ -31,25 +48,13 @@ class DrawBoard:
         self.square_size = square_size
         self.piece_size = (square_size, square_size)
         self.board_size = (square_size * 8, square_size * 8)
-        self.output = Image.open(self.dir + ICONS + '/board%s.png' % boardtype).resize(self.board_size)
+        self.output = load_sprite(self.dir + ICONS + '/board%s.png' % boardtype, self.board_size).copy()
 
     def _get_piece_positions(self):
-        board = [["" for _ in range(8)] for _ in range(8)]
-        positions = self.fen.split('/')
-        for i, rank in enumerate(positions):
-            j = 0
-            for square in rank:
-                if is_int(square):
-                    j += int(square)
-                    continue
-                board[i][j] = square
-                j += 1
-
-        return board
+        return fen_positions(self.fen)
 
     def _insert_piece(self, coordinate, piece):
-        piece_img = Image.open(self.dir + ICONS + '/' + PIECES_DICT.get(piece) + '.png')
-        piece_img = piece_img.resize(self.piece_size)
+        piece_img = load_sprite(self.dir + ICONS + '/' + PIECES_DICT.get(piece) + '.png', self.piece_size)
         X = coordinate[1] * self.square_size
         Y = coordinate[0] * self.square_size
         self.output.paste(piece_img, (X, Y), piece_img)
@@ -61,6 +66,13 @@ class DrawBoard:
                 if positions[i][j]:
                     self._insert_piece((i, j), positions[i][j])
 
+    def boardArray(self):
+        """
+        Renders the board as a BGR uint8 array, the way cv2 would read it from an image file.
+        """
+        self._add_pieces()
+        return np.array(self.output.convert('RGB'))[:, :, ::-1].copy()
+
     def boardQPixmap(self, dark=True):
         self._add_pieces()
         pil_image = self.output.convert('RGB') 
@@ -75,4 +87,19 @@ class DrawBoard:
         qImg = QImage(cvImg.data, width, height, bytesPerLine, QImage.Format_RGB888)
         qPixmap = QPixmap.fromImage(qImg)
         return qPixmap
-        
+
+def pieceQPixmap(piece, square_size=40, dark=True):
+    """
+    A piece sprite as a QPixmap with transparency, colored like DrawBoard.boardQPixmap.
+    :param piece: fen letter of the piece, e.g. 'K'.
+    """
+    sprite = load_sprite(os.getcwd() + '/' + ICONS + '/' + PIECES_DICT.get(piece) + '.png',
+                         (square_size, square_size))
+    rgba = np.array(sprite.convert('RGBA'))
+    if dark:
+        # boardQPixmap shows dark boards with the red and blue channels swapped
+        rgba = rgba[:, :, [2, 1, 0, 3]]
+    rgba = np.ascontiguousarray(rgba)
+    height, width, _ = rgba.shape
+    qImg = QImage(rgba.data, width, height, 4 * width, QImage.Format_RGBA8888)
+    return QPixmap.fromImage(qImg)
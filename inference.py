@@ -0,0 +1,259 @@
+'''
+A warm, process-wide inference session for ChessConvNet.
+
+Loading the weights is by far the most expensive fixed cost of a snip, so the
+model is loaded once, kept in eval mode with gradients disabled, and reused by
+every call to png2fen.evaluate. If the weights file changes on disk, call
+reload() to pick up the new parameters.
+
+The model can run on one of several backends (see BACKENDS). The fp32 eager model is
+always kept as the reference, and parity() compares a backend's logits against it.
+
+The pipeline feeds gray squares. A model trained on gray stacked into three channels is
+folded into a 1-channel model on load, so the squares are cut with session.channels
+channels (see png2fen.regions2squares).
+'''
+from model import ChessConvNet, fold_grayscale
+from runtime import BACKENDS, MODEL_PATH
+
+import copy
+import io
+import numpy as np
+import os
+import threading
+import torch
+from time import time
+
+
+class OnnxRunner:
+    def __init__(self, model, square_size):
+        """
+        Exports the model to an in-memory ONNX graph and runs it with onnxruntime.
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('the onnx backend requires onnxruntime (pip install onnx onnxruntime)')
+
+        buffer = io.BytesIO()
+        example = torch.zeros(1, model.in_channels, square_size, square_size)
+        torch.onnx.export(model, (example,), buffer, input_names=['squares'], output_names=['logits'],
+                          dynamic_axes={'squares': {0: 'batch'}, 'logits': {0: 'batch'}}, dynamo=False)
+        self.session = onnxruntime.InferenceSession(buffer.getvalue(), providers=['CPUExecutionProvider'])
+
+    def __call__(self, batch):
+        out, = self.session.run(None, {'squares': batch.numpy()})
+        return torch.from_numpy(out)
+
+
+def build_backend(model, backend, square_size):
+    """
+    Wraps an eval mode fp32 ChessConvNet for the given backend.
+    :param backend: one of BACKENDS.
+        'eager': the model itself.
+        'torchscript': a traced and frozen TorchScript module.
+        'int8': linear layers dynamically quantized to int8 (the bulk of the weights is in linear1).
+        'onnx': an exported ONNX graph run by onnxruntime.
+    :return: a callable mapping a float tensor [N, C, H, W] to the logits [N, 13].
+    """
+    if backend == 'eager':
+        return model
+    if backend == 'torchscript':
+        example = torch.zeros(1, model.in_channels, square_size, square_size)
+        with torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(model, example))
+    if backend == 'int8':
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == 'onnx':
+        return OnnxRunner(model, square_size)
+    raise ValueError('unknown backend %r, expected one of %s' % (backend, BACKENDS))
+
+
+class InferenceSession:
+    def __init__(self, model_path=MODEL_PATH, square_size=None, backend='eager', grayscale=True):
+        """
+        :param model_path: path to the state dict of a ChessConvNet.
+        :param square_size: the square size the model was trained on, i.e. the resolution the
+                            squares are classified at. By default it is read from the weights.
+        :param backend: the inference backend, one of BACKENDS.
+        :param grayscale: fold a 3-channel model into a 1-channel one (see model.fold_grayscale).
+                          Set to False to keep the 3 input channels; the pipeline still feeds
+                          them gray squares, stacked into three channels.
+        """
+        if backend not in BACKENDS:
+            raise ValueError('unknown backend %r, expected one of %s' % (backend, BACKENDS))
+        self.model_path = model_path
+        self.requested_square_size = square_size
+        self.square_size = None
+        self.backend = backend
+        self.grayscale = grayscale
+        self.channels = None
+        self.model = None
+        self.runner = None
+        self.mtime = None
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def _validate(model, state_dict):
+        if not isinstance(state_dict, dict):
+            raise ValueError('expected a state dict, got %s' % type(state_dict).__name__)
+        expected = model.state_dict()
+        missing = [k for k in expected if k not in state_dict]
+        unexpected = [k for k in state_dict if k not in expected]
+        if missing or unexpected:
+            raise ValueError('state dict does not match ChessConvNet (missing: %s, unexpected: %s)'
+                             % (missing, unexpected))
+        for key, tensor in expected.items():
+            if state_dict[key].shape != tensor.shape:
+                raise ValueError('shape mismatch for %s: expected %s, got %s'
+                                 % (key, tuple(tensor.shape), tuple(state_dict[key].shape)))
+
+    def load(self):
+        """
+        (Re)loads the weights from model_path, validates them and swaps the live model.
+        """
+        mtime = os.path.getmtime(self.model_path)
+        state_dict = torch.load(self.model_path, map_location=torch.device('cpu'))
+        if not isinstance(state_dict, dict):
+            raise ValueError('expected a state dict, got %s' % type(state_dict).__name__)
+        if self.grayscale and 'conv1.weight' in state_dict and state_dict['conv1.weight'].shape[1] == 3:
+            state_dict = fold_grayscale(state_dict)
+        model = ChessConvNet.from_state_dict(state_dict, square_size=self.requested_square_size)
+        self._validate(model, state_dict)
+        model.load_state_dict(state_dict)
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        runner = build_backend(model, self.backend, model.square_size)
+
+        with self._lock:
+            self.model = model
+            self.runner = runner
+            self.channels = model.in_channels
+            self.square_size = model.square_size
+            self.mtime = mtime
+
+    def fingerprint(self):
+        """
+        Identifies the weights and backend the session currently classifies with.
+        """
+        return (os.path.abspath(self.model_path), self.mtime, self.backend, self.square_size, self.channels)
+
+    def is_stale(self):
+        return os.path.getmtime(self.model_path) != self.mtime
+
+    def reload(self, force=False):
+        """
+        Reloads the model if the weights file changed on disk (or always, if force).
+        :return: True if the model was reloaded.
+        """
+        if force or self.is_stale():
+            self.load()
+            return True
+        return False
+
+    def logits(self, batch):
+        """
+        :param batch: float tensor of shape [N, channels, square_size, square_size].
+        :return: the raw model output of shape [N, 13].
+        """
+        runner = self.runner
+        with torch.inference_mode():
+            return runner(batch)
+
+    def parity(self, squares=None, samples=256, seed=0):
+        """
+        Compares the logits of this session's backend against the fp32 eager model.
+        :param squares: uint8 array [N, channels, square_size, square_size] to compare on. Defaults to
+                        random squares, but real board squares make a more meaningful check.
+        :return: dict with the maximal absolute logit difference and the fraction of squares
+                 whose predicted label agrees with the reference.
+        """
+        if squares is None:
+            rng = np.random.RandomState(seed)
+            squares = rng.randint(0, 256, [samples, self.channels, self.square_size, self.square_size],
+                                  dtype=np.uint8)
+        batch = torch.from_numpy(np.ascontiguousarray(squares)).float()
+        with torch.inference_mode():
+            reference = self.model(batch)
+            logits = self.runner(batch)
+        return {'backend': self.backend,
+                'max_abs_diff': float((logits - reference).abs().max()),
+                'agreement': float((logits.argmax(1) == reference.argmax(1)).float().mean())}
+
+    def predict(self, squares, max_batch_size=None):
+        """
+        Classifies a stack of squares, max_batch_size squares per forward pass.
+        :param squares: uint8 array of shape [N, channels, square_size, square_size].
+        :param max_batch_size: int or None. None classifies everything in one pass.
+        :return: int array of N label indices (see png2fen.LABELS_DICT).
+        """
+        squares = np.ascontiguousarray(squares)
+        if len(squares) == 0:
+            return np.zeros(0, dtype=np.int64)
+        step = max_batch_size or len(squares)
+        labels = []
+        for i in range(0, len(squares), step):
+            batch = torch.from_numpy(squares[i:i + step]).float()
+            labels.append(torch.argmax(self.logits(batch), dim=1))
+        return torch.cat(labels).numpy()
+
+    def evaluate(self, img, **kwargs):
+        """
+        Same as png2fen.evaluate, but always uses this session.
+        """
+        from png2fen import evaluate
+        return evaluate(img, session=self, **kwargs)
+
+    def evaluate_many(self, images, **kwargs):
+        """
+        Same as png2fen.evaluate_many, but always uses this session.
+        """
+        from png2fen import evaluate_many
+        return evaluate_many(images, session=self, **kwargs)
+
+
+def fastest_backend(model_path=MODEL_PATH, squares=None, backends=BACKENDS, min_agreement=1.0, repeats=5):
+    """
+    Times every available backend on the host and returns the fastest one whose predictions
+    agree with the fp32 model on at least min_agreement of the squares.
+    :return: (backend name, {backend: report}), where a report holds the parity results and the
+             mean seconds per forward pass, or the error if the backend is unavailable.
+    """
+    reports = {}
+    for backend in backends:
+        try:
+            session = InferenceSession(model_path, backend=backend)
+        except ImportError as e:
+            reports[backend] = {'backend': backend, 'error': str(e)}
+            continue
+        report = session.parity(squares)
+        batch = squares
+        if batch is None:
+            batch = np.zeros([64, session.channels, session.square_size, session.square_size], dtype=np.uint8)
+        session.predict(batch)
+        start = time()
+        for _ in range(repeats):
+            session.predict(batch)
+        report['seconds'] = (time() - start) / repeats
+        reports[backend] = report
+
+    accurate = [r for r in reports.values() if 'seconds' in r and r['agreement'] >= min_agreement]
+    best = min(accurate, key=lambda r: r['seconds'])['backend'] if accurate else 'eager'
+    return best, reports
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(model_path=MODEL_PATH, backend='eager'):
+    """
+    Returns the process-wide session, creating it on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None or _session.model_path != model_path or _session.backend != backend:
+            _session = InferenceSession(model_path, backend=backend)
+        return _session
@@ -1,19 +1,19 @@
 import sys
-from time import sleep
+from time import perf_counter, sleep
+LAUNCHED = perf_counter()
 from functools import partial
 
-from PyQt5.QtCore import QSize, Qt, QPoint, QRect
+from PyQt5.QtCore import QSize, Qt, QPoint, QRect, QThreadPool
 from PyQt5.QtGui import QIcon, QIntValidator, QPixmap
 from PyQt5.QtWidgets import (QAction, QApplication, QCheckBox, QComboBox,
                             QLabel, QDialog, QDialogButtonBox, QPushButton,
-                            QSystemTrayIcon, QLineEdit, QMainWindow, QMenu,
+                            QProgressDialog, QSystemTrayIcon, QLineEdit, QMainWindow, QMenu,
                             QHBoxLayout, QVBoxLayout, QGridLayout
                             )
 
-from utils import (SnippingTool, BoardWidget,
-                   square_extended_fen_position, extend_fen,
-                   compress_fen, flip_fen)
-from fen2png import DrawBoard, PIECES_DICT, INV_PIECES_DICT
+from utils import (SnippingTool, BoardWidget, RecognitionTask, PrewarmTask, ScreenWatcher,
+                   square_extended_fen_position, flip_fen, grabScreenRect, pixmap2array)
+from board import Board, PIECES_DICT, INV_PIECES_DICT
 from help_messages import *
 
 
@@ -99,17 +99,13 @@ class FenSettingsWindow(QDialog):
         if self.boardType == 'b':
             rank = 7 - rank
         splitted_fen = self.fen.split(' ')
-        extended_fen = extend_fen(splitted_fen[0].split('/'))
-        extended_fen[rank] = extended_fen[rank][:file] + INV_PIECES_DICT[piece] + extended_fen[rank][file + 1:]
-        new_fen = ' '.join([compress_fen('/'.join(extended_fen)), *splitted_fen[1:]])
+        board = Board.from_fen(splitted_fen[0])
+        board[rank, file] = INV_PIECES_DICT[piece]
+        new_fen = ' '.join([board.to_fen(), *splitted_fen[1:]])
         
         self.fen = new_fen
         self.fenLineEdit.setText(new_fen)
-        if self.boardType == 'w':
-            board = DrawBoard(self.fen, boardtype=self.boardType)
-        else:
-            board = DrawBoard(flip_fen(self.fen), boardtype=self.boardType)
-        self.boardImage.setPixmap(board.boardQPixmap())
+        self.updateBoard()
 
     def rightMoueseClick(self, x, y, e):
         self.clickCoordinates = [x, y]
@@ -124,10 +120,8 @@ class FenSettingsWindow(QDialog):
             cb.setText(self.fen, mode=cb.Clipboard)
         else:
             tmp_fen = self.fen.split()
-            fen_position = tmp_fen[0].split('/')
-            for i, rank in enumerate(fen_position):
-                fen_position[i] = rank[::-1]
-            cb.setText(' '.join(['/'.join(fen_position), *tmp_fen[1:]]), mode=cb.Clipboard)
+            fen_position = Board.from_fen(tmp_fen[0]).mirrored().to_fen()
+            cb.setText(' '.join([fen_position, *tmp_fen[1:]]), mode=cb.Clipboard)
 
         self.close()        
 
@@ -136,17 +130,17 @@ class FenSettingsWindow(QDialog):
             self.boardType = 'w'
         else:
             self.boardType = 'b'
-        tmp_fen = self.fen.split()
-        fen_position = tmp_fen[0].split('/')[::-1]
-        self.fenLineEdit.setText(' '.join(['/'.join(fen_position), *tmp_fen[1:]]))
+        self.fenLineEdit.setText(flip_fen(self.fen))
 
         # Manually update fen and board to avoid unwanted flippings in other calls to the method
         self.fen = self.fenLineEdit.text()
+        self.updateBoard()
+
+    def updateBoard(self):
         if self.boardType == 'w':
-            board = DrawBoard(self.fen, boardtype=self.boardType)
+            self.boardImage.setPosition(self.fen, self.boardType)
         else:
-            board = DrawBoard(flip_fen(self.fen), boardtype=self.boardType)
-        self.boardImage.setPixmap(board.boardQPixmap())
+            self.boardImage.setPosition(flip_fen(self.fen), self.boardType)
 
     def configChanged(self):
         castlingPart = []
@@ -307,15 +301,46 @@ class MainWindow(QMainWindow):
         self.trayIcon.show()
 
         self.messageDialog = QDialog()
-        
+        self.recognitionTask = None
+        self.progressDialog = None
+        self.screenWatcher = None
+        # The screen rect and the fitted grid of the last successful snip, for re-snipping
+        self.lastSnipRect = None
+        self.lastSnipRegions = None
+        self.recognitionRect = None
+        self.prewarm()
+
+    def prewarm(self):
+        # Load the model while the tray icon is idle, so the first snip doesn't pay for it
+        self.prewarmTask = PrewarmTask()
+        self.prewarmTask.signals.finished.connect(self.prewarmFinished)
+        self.prewarmTask.signals.failed.connect(self.prewarmFailed)
+        QThreadPool.globalInstance().start(self.prewarmTask)
+
+    def prewarmFinished(self, importTimes):
+        print('model ready %.0f ms after launch (imports: %s)' % (1000 * (perf_counter() - LAUNCHED), importTimes),
+              file=sys.stderr)
+
+    def prewarmFailed(self, error):
+        self.trayIcon.showMessage('', 'Could not load the model: %s' % error,
+                                  QSystemTrayIcon.Warning, 10 * 1000)
+
     def createActions(self):
         self.snipAction = QAction("Snip", self, triggered=self.snip)
+        self.resnipAction = QAction("Re-snip last region", self, triggered=self.resnip)
+        self.resnipAction.setEnabled(False)
+        self.watchAction = QAction("Watch region", self, triggered=self.watch)
+        self.stopWatchingAction = QAction("Stop watching", self, triggered=self.stopWatching)
+        self.stopWatchingAction.setEnabled(False)
         self.quitAction = QAction('&Quit', self, triggered=QApplication.instance().quit)
 
     def createTrayIcon(self):
         self.trayIconMenu = QMenu(self)
 
         self.trayIconMenu.addAction(self.snipAction)
+        self.trayIconMenu.addAction(self.resnipAction)
+        self.trayIconMenu.addAction(self.watchAction)
+        self.trayIconMenu.addAction(self.stopWatchingAction)
         self.trayIconMenu.addAction(self.quitAction)
 
         self.trayIcon = QSystemTrayIcon(self)
@@ -327,13 +352,110 @@ class MainWindow(QMainWindow):
     def snip(self):
         snipping_tool = SnippingTool()
         snipping_tool.show()
-        snipping_tool.exec_()
-
-        self.optsWindow = FenSettingsWindow(snipping_tool.fen)
+        if not snipping_tool.exec_() or snipping_tool.selectedArray is None:
+            return
+        self.recognize(snipping_tool.selectedArray, snipping_tool.selectedRect.normalized())
+
+    def resnip(self):
+        # Same screen rect and grid as the last snip: no selection overlay and no detection
+        if self.lastSnipRect is None:
+            return
+        pixmap = grabScreenRect(self.lastSnipRect)
+        if pixmap.isNull():
+            return
+        self.recognize(pixmap2array(pixmap), self.lastSnipRect, self.lastSnipRegions)
+
+    def recognize(self, image, rect, regions=None):
+        if self.recognitionTask is not None:
+            self.recognitionTask.cancel()
+        if self.progressDialog is not None:
+            # Otherwise the minimum duration timer of the replaced dialog can still show it
+            self.progressDialog.canceled.disconnect()
+            self.progressDialog.reset()
+            self.progressDialog.deleteLater()
+            self.progressDialog = None
+        self.recognitionRect = rect
+        self.recognitionTask = RecognitionTask(image, resizing=450, regions=regions)
+        self.recognitionTask.signals.progress.connect(self.recognitionProgress)
+        self.recognitionTask.signals.finished.connect(self.recognitionFinished)
+        self.recognitionTask.signals.failed.connect(self.recognitionFailed)
+        self.recognitionTask.signals.cancelled.connect(self.recognitionCancelled)
+
+        self.progressDialog = QProgressDialog('Recognizing the board...', 'Cancel', 0, len(RecognitionTask.STAGES))
+        self.progressDialog.setWindowTitle('SnipChess')
+        # Fast recognitions finish before the dialog would show up
+        self.progressDialog.setMinimumDuration(300)
+        self.progressDialog.canceled.connect(self.recognitionTask.cancel)
+        self.progressDialog.setValue(0)
+
+        QThreadPool.globalInstance().start(self.recognitionTask)
+
+    def isCurrentRecognition(self):
+        # Signals of a task that was replaced by a newer snip are ignored
+        return self.recognitionTask is not None and self.sender() is self.recognitionTask.signals
+
+    def recognitionProgress(self, value, text):
+        if self.isCurrentRecognition():
+            self.progressDialog.setLabelText(text)
+            self.progressDialog.setValue(value)
+
+    def recognitionFinished(self, fen):
+        if not self.isCurrentRecognition():
+            return
+        self.lastSnipRect = self.recognitionRect
+        self.lastSnipRegions = self.recognitionTask.regions
+        self.resnipAction.setEnabled(True)
+        self.recognitionTask = None
+        self.progressDialog.reset()
+
+        self.optsWindow = FenSettingsWindow(fen)
+        self.optsWindow.accepted.connect(self.fenCopied)
         self.optsWindow.show()
 
-        if self.optsWindow.exec_():
-            self.trayIcon.showMessage('', 'FEN has been successfuly copied to clipboard!',  self.icon, 50 * 1000)
+    def recognitionFailed(self, error):
+        if not self.isCurrentRecognition():
+            return
+        self.recognitionTask = None
+        self.progressDialog.reset()
+        self.trayIcon.showMessage('', 'Could not recognize the board: %s' % error,
+                                  QSystemTrayIcon.Warning, 10 * 1000)
+
+    def recognitionCancelled(self):
+        if self.isCurrentRecognition():
+            self.recognitionTask = None
+            self.progressDialog.reset()
+
+    def watch(self):
+        snipping_tool = SnippingTool()
+        snipping_tool.show()
+        if not snipping_tool.exec_() or snipping_tool.selectedArray is None:
+            return
+
+        self.stopWatching()
+        self.screenWatcher = ScreenWatcher(snipping_tool.selectedRect.normalized())
+        self.screenWatcher.fenChanged.connect(self.watchedFenChanged)
+        self.screenWatcher.failed.connect(self.watchFailed)
+        self.screenWatcher.start()
+        self.stopWatchingAction.setEnabled(True)
+
+    def stopWatching(self):
+        if self.screenWatcher is not None:
+            self.screenWatcher.stop()
+            self.screenWatcher = None
+        self.stopWatchingAction.setEnabled(False)
+
+    def watchFailed(self, error):
+        self.stopWatching()
+        self.trayIcon.showMessage('', 'Stopped watching: %s' % error, QSystemTrayIcon.Warning, 10 * 1000)
+
+    def watchedFenChanged(self, fen):
+        # Publish every new position on stdout and in the clipboard
+        print(fen, flush=True)
+        QApplication.clipboard().setText(fen)
+        self.trayIcon.showMessage('', 'Position changed: %s' % fen, self.icon, 5 * 1000)
+
+    def fenCopied(self):
+        self.trayIcon.showMessage('', 'FEN has been successfuly copied to clipboard!',  self.icon, 50 * 1000)
 
 
 def main():
@@ -341,6 +463,7 @@ def main():
     app.setQuitOnLastWindowClosed(False)
     window = MainWindow()
     window.hide()
+    print('tray ready %.0f ms after launch' % (1000 * (perf_counter() - LAUNCHED)), file=sys.stderr)
 
     sys.exit(app.exec_())
 
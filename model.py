@@ -1,27 +1,73 @@
 from torch.nn import Conv2d, ReLU, MaxPool2d, Linear, Module
 from torch import flatten
 
+def fold_grayscale(state_dict):
+    """
+    Converts the weights of a model fed with gray squares stacked into three identical channels
+    into the weights of a 1-channel model with the same output: conv1 sums its kernels over
+    the input channels.
+    """
+    state_dict = dict(state_dict)
+    state_dict['conv1.weight'] = state_dict['conv1.weight'].sum(dim=1, keepdim=True)
+    return state_dict
+
+
+# Smaller architectures to distill the default model into (see train.py)
+VARIANTS = {'base': {},
+            'small': {'channels': (8, 16, 16, 8), 'out_channels': 8, 'hidden': 128},
+            'tiny': {'channels': (4, 8, 8, 4), 'out_channels': 4, 'hidden': 64}}
+
+
 class ChessConvNet(Module):
-    def __init__(self, square_size=80, out_channels=10):
+    def __init__(self, square_size=80, out_channels=10, channels=(10, 20, 20, 10), hidden=500, in_channels=3):
+        """
+        :param square_size: the side of the input squares, in pixels (a multiple of 4).
+        :param out_channels: channels of the last conv layer (they make the input of linear1).
+        :param channels: output channels of conv1 to conv4.
+        :param hidden: the width of linear1 and linear2.
+        """
         super(ChessConvNet, self).__init__()
-        self.in_channels = 3
+        self.square_size = square_size
+        self.in_channels = in_channels
         self.out_channels = out_channels
+        self.channels = tuple(channels)
+        self.hidden = hidden
         self.out_vector_length = 13
 
         self.relu = ReLU(inplace=True)
         self.maxpool1 = MaxPool2d(kernel_size=2, stride=2, padding=0, dilation=1, ceil_mode=False)
         self.maxpool2 = MaxPool2d(kernel_size=2, stride=2, padding=0, dilation=1, ceil_mode=False)
 
-        self.conv1 = Conv2d(self.in_channels, 10, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
-        self.conv2 = Conv2d(10, 20, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
-        self.conv3 = Conv2d(20, 20, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
-        self.conv4 = Conv2d(20, 10, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
-        self.conv5 = Conv2d(10, self.out_channels, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+        c1, c2, c3, c4 = self.channels
+        self.conv1 = Conv2d(self.in_channels, c1, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+        self.conv2 = Conv2d(c1, c2, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+        self.conv3 = Conv2d(c2, c3, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+        self.conv4 = Conv2d(c3, c4, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+        self.conv5 = Conv2d(c4, self.out_channels, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
 
         infeatures = int(self.out_channels * (square_size / 4) ** 2)
-        self.linear1 = Linear(in_features=infeatures, out_features=500, bias=True)
-        self.linear2 = Linear(in_features=500, out_features=500, bias=True)
-        self.linear3 = Linear(in_features=500, out_features=13, bias=True)
+        self.linear1 = Linear(in_features=infeatures, out_features=hidden, bias=True)
+        self.linear2 = Linear(in_features=hidden, out_features=hidden, bias=True)
+        self.linear3 = Linear(in_features=hidden, out_features=13, bias=True)
+
+    @classmethod
+    def from_state_dict(cls, state_dict, square_size=None):
+        """
+        Builds the architecture the state dict was saved from (any of VARIANTS, or other sizes).
+        The weights are not loaded.
+        :param square_size: the square size the model was trained on. By default it is derived
+                            from the size of linear1.
+        """
+        def out_features(layer):
+            return state_dict[layer + '.weight'].shape[0]
+        try:
+            if square_size is None:
+                square_size = int(round(4 * (state_dict['linear1.weight'].shape[1] / out_features('conv5')) ** 0.5))
+            return cls(square_size=square_size, out_channels=out_features('conv5'),
+                       channels=[out_features('conv%d' % i) for i in range(1, 5)],
+                       hidden=out_features('linear1'), in_channels=state_dict['conv1.weight'].shape[1])
+        except (KeyError, AttributeError, IndexError, TypeError):
+            raise ValueError('the state dict is not one of a ChessConvNet')
 
 
     def forward(self, x):
@@ -8,14 +8,14 @@ Thoughts:
    selective-search consider deflate the png after reading it from the user to get the squares,
    and only than inflate to classify. This may be a bit problematic - TEST the inflatet square!!!
 '''
-from model import ChessConvNet
+from board import Board
+from inference import MODEL_PATH, get_session
+from runtime import get_config
+from tracing import span
 
 import cv2
 from time import time
 import numpy as np
-import os
-import torch
-import sys
 
 
 PIECES = "RBNQKPrbnqkp"
@@ -35,22 +35,27 @@ LABELS_DICT = {'e': 0,
                'wk': 11,
                'wp': 12}
 LABELS_LIST = [k for k, v in LABELS_DICT.items()]
-MODEL_PATH = 'parameters.pt'
+DETECTION_MODES = ('auto', 'grid', 'ss')
+GRID_MIN_CONFIDENCE = 2.0
+# A square whose center has a pixel standard deviation below this is empty for sure (empty
+# squares are flat, up to noise; pieces are way above 30)
+EMPTY_MAX_STD = 8.
 
+# The threads of OpenCV and torch for this host (see runtime.py)
+get_config()
 
-def ss_regions(cvimage, verbosity=True):
-
-    # speed-up using multithreads
-    cv2.setUseOptimized(True)
-    cv2.setNumThreads(4)
 
+def ss_regions(cvimage, verbosity=True):
+    # OpenCV's threads are set once per process from the runtime profile (see runtime.py)
     ss = cv2.ximgproc.segmentation.createSelectiveSearchSegmentation()
     ss.setBaseImage(cvimage)
     ss.switchToSelectiveSearchFast()
 
     # run selective search on the input image
     start = time()
-    rects = ss.process()
+    with span('selective_search', image=cvimage.shape[:2]) as s:
+        rects = ss.process()
+        s.set(proposals=len(rects))
     end = time()
 
     if verbosity:
@@ -64,35 +69,225 @@ def ss_regions(cvimage, verbosity=True):
             new_rects.append([x, y, w, h])
     new_rects = np.array(new_rects)
 
-    fixed_rects = np.array([[0 for _ in range(4)] for _ in range(64)])
+    with span('grid_fit', candidates=len(new_rects)) as fit_span:
+        x0, y0, box_size = _solve_grid(new_rects, cvimage.shape[0])
+        fit_span.set(box_size=float(box_size), origin=(float(x0), float(y0)))
+    if verbosity:
+        print('square size = {:.2f}, origin = ({:.1f}, {:.1f})'.format(box_size, x0, y0))
 
-    min_indices = np.argmin(new_rects, axis=0)
-    xp, _, wp, hp = new_rects[min_indices[0]]  # Here I (arbitrarily) use x as the min. Could use y instead.
-    box_size = max(wp, hp)
+    # Now construct the new 64 fixed rects
+    size = int(round(box_size))
+    fixed_rects = np.zeros([64, 4], dtype=int)
+    for i in range(8):
+        for j in range(8):
+            fixed_rects[8 * i + j] = [int(round(x0 + box_size * j)), int(round(y0 + box_size * i)), size, size]
+    return fixed_rects
 
-    idx = 0
-    while True:
-        condition = xp + box_size * 8 - (cvimage.shape[0] - xp)
-        if abs(condition) > 3:
-            box_size -= 1 * np.sign(condition)
-            idx += 1
-            if idx % 10 == 0:
-                xp += 2
-            if verbosity:
-                print('Margin deviation = %d. Now box size = %d' % (condition, box_size))
-                if idx % 10 == 0:
-                    print('Reached %d iterations. Now xp = %d' % (idx, xp))
-            continue
-        else:
+def _lattice_indices(coords, period):
+    """
+    Numbers the lattice positions of coordinates spaced by about a multiple of period, counting
+    the steps between neighbouring coordinates so that an inexact period does not add up.
+    """
+    order = np.argsort(coords)
+    indices = np.empty(len(coords))
+    indices[order] = np.concatenate([[0], np.cumsum(np.round(np.diff(coords[order]) / period))])
+    return indices
+
+def _lattice_support(rects, period):
+    """
+    The proposals with a side of about period whose centers sit on one lattice of that period.
+    :return: (boolean mask of the proposals, number of distinct lattice positions they cover)
+    """
+    sides = rects[:, 2:].max(axis=1)
+    centers = rects[:, :2] + rects[:, 2:] / 2
+    similar = np.abs(sides - period) <= 0.15 * period
+    # The phase of every center within its square, and the most common phase as an angle mean
+    angles = 2 * np.pi * centers / period
+    phase = np.arctan2(np.sin(angles[similar]).sum(axis=0), np.cos(angles[similar]).sum(axis=0))
+    offsets = np.abs(np.angle(np.exp(1j * (angles - phase)))) / (2 * np.pi)
+    mask = similar & (offsets <= 0.25).all(axis=1)
+    cells = np.round((centers[mask] - phase * period / (2 * np.pi)) / period)
+    return mask, len(np.unique(cells, axis=0))
+
+def _solve_grid(rects, image_size):
+    """
+    Fits the 8x8 grid to square proposals in closed form. Squares are proposed along with
+    pieces, details and blocks of neighbouring squares, so the first estimate of the square
+    size is the proposal side that covers the most positions of one lattice: smaller and
+    larger proposals don't line up on a lattice of their own size. Every square proposal on
+    that lattice then gets its file and rank index, and a single least squares solve gives the
+    origin and the square size from all of them at once. Proposals off the lattice by more
+    than a quarter square are dropped and the solve is repeated once.
+    :param rects: array of square-ish proposals [x, y, w, h].
+    :return: (x0, y0, square size), as floats.
+    """
+    if len(rects) == 0:
+        return 0., 0., image_size / 8
+    supports = {side: _lattice_support(rects, side) for side in np.unique(rects[:, 2:].max(axis=1))}
+    # Ties go to the larger side, whose smaller neighbours are more likely pieces
+    mask, _ = supports[max(supports, key=lambda side: (supports[side][1], side))]
+    squares = rects[mask]
+    period = float(np.median(squares[:, 2:].max(axis=1)))
+    # Proposals are often a little smaller than their square, but centered on it
+    x = squares[:, 0] + squares[:, 2] / 2
+    y = squares[:, 1] + squares[:, 3] / 2
+    files = _lattice_indices(x, period)
+    ranks = _lattice_indices(y, period)
+
+    inliers = np.ones(len(squares), dtype=bool)
+    for _ in range(2):
+        # x = x0 + file * size and y = y0 + rank * size, x and y sharing the square size
+        n = int(inliers.sum())
+        design = np.zeros([2 * n, 3])
+        design[:n, 0] = 1
+        design[n:, 1] = 1
+        design[:, 2] = np.concatenate([files[inliers], ranks[inliers]])
+        positions = np.concatenate([x[inliers], y[inliers]])
+        (x0, y0, size), _, rank, _ = np.linalg.lstsq(design, positions, rcond=None)
+        if rank < 3:
+            # All the proposals on one file or rank: keep the median side
+            return x.min() - period / 2, y.min() - period / 2, period
+        residuals = np.maximum(np.abs(x0 + files * size - x), np.abs(y0 + ranks * size - y))
+        inliers = residuals <= size / 4
+        if inliers.sum() < 3:
             break
-        # Now construct the new 64 fixed rects
-    idx = 0
+    if abs(size - period) > 0.1 * period:
+        # The proposals don't agree on a lattice (e.g. no board at all): keep the median side,
+        # and the origin that puts the most proposals on it
+        size = period
+        x0 = float(np.median(x - files * size))
+        y0 = float(np.median(y - ranks * size))
+    size = min(size, image_size / 8)
+    x0 -= size / 2
+    y0 -= size / 2
+    # Indices are counted from the leftmost and topmost proposals, which may not be on the first
+    # file and rank: shift the grid back by whole squares until it ends inside the image
+    x0 -= size * max(0, np.ceil((x0 + 8 * size - image_size - size / 4) / size))
+    y0 -= size * max(0, np.ceil((y0 + 8 * size - image_size - size / 4) / size))
+    x0 = float(np.clip(x0, 0, image_size - 8 * size))
+    y0 = float(np.clip(y0, 0, image_size - 8 * size))
+    return x0, y0, size
+
+def _edge_profiles(gray):
+    """
+    Column and row profiles of the absolute intensity steps. profile[i] is the total edge
+    strength between pixels i - 1 and i, so a grid line at coordinate i shows as a peak at i.
+    """
+    gray = gray.astype(np.float32)
+    col_profile = np.zeros(gray.shape[1] + 1, dtype=np.float32)
+    row_profile = np.zeros(gray.shape[0] + 1, dtype=np.float32)
+    col_profile[1:-1] = np.abs(np.diff(gray, axis=1)).sum(axis=0)
+    row_profile[1:-1] = np.abs(np.diff(gray, axis=0)).sum(axis=1)
+    # Tolerate lines smeared over two pixels by resizing
+    col_profile = np.maximum(col_profile, np.maximum(np.roll(col_profile, 1), np.roll(col_profile, -1)))
+    row_profile = np.maximum(row_profile, np.maximum(np.roll(row_profile, 1), np.roll(row_profile, -1)))
+    return col_profile, row_profile
+
+def _fit_lines(profile, period):
+    """
+    Finds the offset at which 9 equally spaced lines hit the strongest edges.
+    :return: (score, offset)
+    """
+    length = len(profile) - 1
+    offsets = np.arange(0, int(length - 8 * period) + 1)
+    lines = np.rint(offsets[:, None] + period * np.arange(9)[None, :]).astype(int)
+    scores = profile[np.minimum(lines, length)].sum(axis=1)
+    best = np.argmax(scores)
+    return scores[best], offsets[best]
+
+def _line_strength(profile, positions):
+    """
+    The edge strength at each position, 0 outside the profile.
+    """
+    positions = np.rint(positions).astype(int)
+    inside = (positions >= 0) & (positions < len(profile))
+    return np.where(inside, profile[np.clip(positions, 0, len(profile) - 1)], 0.)
+
+def _bounds_board(profile, period, offset, ratio=0.5):
+    """
+    Whether the 9 lines fitted at offset and period look like the edges of a whole board: every
+    line off the image border is present, and the lines a square outside them and halfway between
+    them are much weaker.
+    """
+    positions = offset + period * np.arange(9)
+    strengths = _line_strength(profile, positions)
+    lines = strengths.mean()
+    # A board edge on (or a few pixels from) the image border leaves no clear step in the profile
+    margin = max(2, period / 8)
+    inner = strengths[(positions >= margin) & (positions <= len(profile) - 1 - margin)]
+    outside = _line_strength(profile, offset + period * np.array([-1, 9])).max()
+    halfway = _line_strength(profile, offset + period * (np.arange(8) + 0.5)).mean()
+    return inner.min() >= ratio * lines / 2 and outside < ratio * lines and halfway < ratio * lines
+
+def grid_regions(cvimage, verbosity=False, return_confidence=False, check_bounds=True):
+    """
+    Locates the 8x8 grid directly from the board's regular structure, without region proposals.
+    The edge profiles along both axes are matched against 9 equally spaced lines, for every
+    candidate square size in steps of a quarter pixel. The board may span as little as half of
+    the image, like a loose snip. Unless check_bounds is False, the confidence is zero when the
+    fitted lines don't bound a board: when there are strong lines a square beyond them (the fit
+    is a part of a larger grid) or halfway between them (the squares are smaller).
+    :param cvimage: BGR board image.
+    :param return_confidence: if True, also return the ratio between the edge strength on the
+                              fitted lines and the mean edge strength.
+    :param check_bounds: bool. set the confidence to zero if the lines don't bound a board (see
+                         above). Text right next to the board, e.g. a caption, also fails this check.
+    """
+    start = time()
+    gray = cv2.cvtColor(cvimage, cv2.COLOR_BGR2GRAY) if cvimage.ndim == 3 else cvimage
+    col_profile, row_profile = _edge_profiles(gray)
+    size = min(gray.shape[:2])
+
+    with span('grid_fit') as fit_span:
+        best = None
+        periods = np.arange(size / 8, size / 16 - 0.25, -0.25)
+        # Iterate from the largest square size so ties go to the grid that covers the most
+        for period in periods:
+            xscore, x0 = _fit_lines(col_profile, period)
+            yscore, y0 = _fit_lines(row_profile, period)
+            if best is None or xscore + yscore > best[0]:
+                best = (xscore + yscore, period, x0, y0)
+        score, period, x0, y0 = best
+        box_size = int(round(period))
+        fit_span.set(iterations=len(periods), box_size=float(period), origin=(int(x0), int(y0)))
+
+    fixed_rects = np.zeros([64, 4], dtype=int)
     for i in range(8):
         for j in range(8):
-            fixed_rects[idx] = [xp + box_size * j, xp + box_size * i, box_size, box_size]
-            idx += 1
+            fixed_rects[8 * i + j] = [int(round(x0 + period * j)), int(round(y0 + period * i)), box_size, box_size]
+
+    mean_strength = (col_profile.mean() + row_profile.mean()) / 2
+    confidence = score / 18 / mean_strength if mean_strength > 0 else 0.
+    if check_bounds and not (_bounds_board(col_profile, period, x0) and _bounds_board(row_profile, period, y0)):
+        confidence = 0.
+    if verbosity:
+        print("grid detection took {:.4f} seconds".format(time() - start))
+        print("square size = {:.2f}, origin = ({}, {}), confidence = {:.2f}".format(period, x0, y0, confidence))
+    if return_confidence:
+        return fixed_rects, confidence
     return fixed_rects
 
+def board_regions(cvimage, mode='auto', verbosity=False):
+    """
+    Returns the 64 square rects [x, y, w, h] of the board, in reading order.
+    :param mode: 'grid' for the grid detector, 'ss' for selective search, or 'auto' for the
+                 grid detector with selective search as a fallback when the grid is unclear.
+    """
+    if mode not in DETECTION_MODES:
+        raise ValueError('unknown detection mode %r, expected one of %s' % (mode, DETECTION_MODES))
+    with span('regions', mode=mode, image=cvimage.shape[:2]) as s:
+        if mode == 'ss':
+            s.set(detector='ss')
+            return ss_regions(cvimage, verbosity=verbosity)
+        regions, confidence = grid_regions(cvimage, verbosity=verbosity, return_confidence=True)
+        s.set(detector='grid', confidence=float(confidence))
+        if mode == 'auto' and confidence < GRID_MIN_CONFIDENCE:
+            if verbosity:
+                print('grid confidence {:.2f} is too low, falling back to selective search'.format(confidence))
+            s.set(detector='ss')
+            return ss_regions(cvimage, verbosity=verbosity)
+        return regions
+
 def visualize_regions(cvimage, regions):
     while True:
         # create a copy of original image
@@ -115,75 +310,391 @@ def visualize_regions(cvimage, regions):
     # close image show window
     cv2.destroyAllWindows()
 
-def regions2squares(cvimage, regions, square_size=80, grayscale=True):
-    if grayscale:
-        cvimage = cv2.cvtColor(cvimage, cv2.COLOR_BGR2GRAY)
-        cvimage = np.array([cvimage, cvimage, cvimage])
-        cvimage = np.moveaxis(cvimage, 0, -1)
+def tile_squares(board, square_size, channels=3):
+    """
+    Splits a board image of exactly 8 * square_size pixels into its 64 squares without copying.
+    A single channel board is broadcast to `channels` identical channels with a zero stride.
+    :param board: uint8 array of shape [8 * square_size, 8 * square_size] or [..., ..., C].
+    :return: read-only view of shape [8, 8, C, square_size, square_size] (rank, file, C, H, W).
+    """
+    if board.ndim == 2:
+        board = board[:, :, None]
+    row_stride, col_stride, channel_stride = board.strides
+    if board.shape[2] == 1:
+        channel_stride = 0
+    else:
+        channels = board.shape[2]
+    return np.lib.stride_tricks.as_strided(
+        board,
+        shape=(8, 8, channels, square_size, square_size),
+        strides=(row_stride * square_size, col_stride * square_size, channel_stride, row_stride, col_stride),
+        writeable=False)
 
-    squares = np.zeros([64, square_size, square_size, 3], dtype=np.uint8)
-    for i in range(64):
-        imOut = cvimage.copy()
-        x, y, w, h = regions[i]
-        squares[i, :, :] = cv2.resize(imOut[y:y+w, x:x+w, :], (square_size, square_size))
+def regions2squares(cvimage, regions, square_size=80, grayscale=True, channels=3):
+    """
+    Crops the board spanned by the regions, resizes it once to 8 * square_size and tiles it.
+    :param channels: the channels of gray squares: 1 for single channel models (see
+                     InferenceSession.channels), 3 for gray stacked into three channels.
+    :return: uint8 array of shape [64, C, square_size, square_size], in reading order.
+    """
+    # Clip the board to the image, negative starts would wrap around
+    height, width = cvimage.shape[:2]
+    x0, y0 = max(0, regions[0][0]), max(0, regions[0][1])
+    x1 = min(width, regions[7][0] + regions[7][2])
+    y1 = min(height, regions[56][1] + regions[56][3])
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('the board regions are outside the image')
+    with span('crop', board=(int(y1 - y0), int(x1 - x0)), square_size=square_size, squares=64):
+        shrink = (y1 - y0) > 8 * square_size
+        board = cv2.resize(cvimage[y0:y1, x0:x1], (8 * square_size, 8 * square_size),
+                           interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+        if grayscale:
+            board = cv2.cvtColor(board, cv2.COLOR_BGR2GRAY)
+        elif board.shape[2] > 3:
+            board = board[:, :, :3]
+
+        # The only copy: flattening the (rank, file) grid of views into a batch
+        tiles = tile_squares(board, square_size, channels=channels)
+        return tiles.reshape(64, tiles.shape[2], square_size, square_size)
+
+def scale_regions(regions, shape, resizing):
+    """
+    Maps regions found on the image resized to resizing x resizing back to the image.
+    :param shape: the shape of the image.
+    """
+    height, width = shape[:2]
+    scale = np.array([width, height, width, height]) / resizing
+    return np.round(np.asarray(regions) * scale).astype(int)
+
+def board_squares(img, resizing=350, square_size=80, detection='auto', channels=3, resized=None,
+                  regions=None):
+    """
+    Runs the image part of the pipeline. The two resolutions are independent: the grid is
+    detected on the image resized to resizing x resizing, and the squares are cut from the
+    full image and resized once, to square_size (the resolution the model classifies at).
+    :param detection: the region detection mode (see board_regions).
+    :param channels: the channels of the squares (see regions2squares).
+    :param resized: optional, the image already resized to resizing x resizing.
+    :param regions: optional square rects on the resized image, e.g. from an earlier image of the
+                    same screen region. Skips the detection.
+    :return: uint8 array of shape [64, C, square_size, square_size], in reading order (a8 first).
+    """
+    if regions is not None:
+        return regions2squares(img, scale_regions(regions, img.shape, resizing), square_size=square_size,
+                               channels=channels)
+    if resized is None:
+        resized = img
+        if img.shape[:2] != (resizing, resizing):
+            with span('resize', size=resizing):
+                resized = cv2.resize(img, (resizing, resizing))
+    regions = board_regions(resized, mode=detection)
+    if resized is not img:
+        regions = scale_regions(regions, img.shape, resizing)
+    return regions2squares(img, regions, square_size=square_size, channels=channels)
 
-    return squares
+def square_fingerprints(squares, size=8, levels=16):
+    """
+    Coarse fingerprints of square tiles: the first channel, area-downsampled to size x size and
+    quantized to `levels` gray levels. Near-identical tiles (e.g. empty squares of the same
+    color) share a fingerprint.
+    :param squares: uint8 array [N, C, H, W].
+    :return: uint8 array [N, size * size].
+    """
+    n, _, height, width = squares.shape
+    tiles = squares[:, 0].astype(np.float32)
+    tiles = tiles[:, :height - height % size, :width - width % size]
+    tiles = tiles.reshape(n, size, height // size, size, width // size).mean(axis=(2, 4))
+    return (tiles // (256 // levels)).astype(np.uint8).reshape(n, size * size)
 
-def evaluate(img, resizing=350, square_vis=None):
+def empty_squares(squares, max_std=EMPTY_MAX_STD, margin=0.125):
+    """
+    The cheap first stage of the classification: a square is empty if its center is flat.
+    The border is left out, since it may hold grid lines or a neighbour's edge.
+    :param squares: uint8 array [N, C, H, W].
+    :return: bool array of N, True for the squares that are empty for sure.
+    """
+    n, _, height, width = squares.shape
+    dy, dx = int(height * margin), int(width * margin)
+    centers = squares[:, 0, dy:height - dy, dx:width - dx].reshape(n, -1)
+    return centers.std(axis=1) < max_std
+
+def classify_squares(squares, session, max_batch_size=None, dedup=True, stats=None, cascade=True):
+    """
+    Classifies squares, sending only one representative of every group of near-identical
+    tiles through the model and spreading its label back to the whole group.
+    :param squares: uint8 array [N, C, square_size, square_size], C as session.channels.
+    :param dedup: bool. False classifies every square.
+    :param stats: optional dict, updated with the number of squares, of squares found empty
+                  by the cascade and of unique squares sent to the model.
+    :param cascade: bool. Squares that empty_squares finds empty are labeled empty without
+                    the model; only occupied or uncertain squares are classified.
+    :return: int array of N label indices.
+    """
+    with span('inference', squares=len(squares), backend=session.backend) as s:
+        labels = np.zeros(len(squares), dtype=np.int64)
+        if cascade and len(squares):
+            occupied = np.flatnonzero(~empty_squares(squares))
+            candidates = squares[occupied]
+        else:
+            occupied = slice(None)
+            candidates = squares
+        if dedup and len(candidates):
+            _, unique, inverse = np.unique(square_fingerprints(candidates), axis=0,
+                                           return_index=True, return_inverse=True)
+            predicted = session.predict(candidates[unique], max_batch_size=max_batch_size)
+            labels[occupied] = predicted[inverse.reshape(-1)]
+        else:
+            unique = candidates
+            labels[occupied] = session.predict(candidates, max_batch_size=max_batch_size)
+        gated = len(squares) - len(candidates)
+        s.set(gated_empty=gated, unique_squares=len(unique))
+    if stats is not None:
+        stats['squares'] = stats.get('squares', 0) + len(squares)
+        stats['gated_empty'] = stats.get('gated_empty', 0) + gated
+        stats['unique_squares'] = stats.get('unique_squares', 0) + len(unique)
+    return labels
+
+def labels2fen(labels):
+    """
+    Assembles the position part of a fen from 64 label indices (see LABELS_DICT).
+    """
+    return Board.from_labels(labels).to_fen()
+
+def _no_progress(stage):
+    pass
+
+def evaluate(img, resizing=350, square_vis=None, session=None, detection='auto', cache=None,
+             dedup=True, stats=None, progress=None, cascade=True, regions=None, fitted=None):
     """
     The functions that converts the board to its fen representation
     :param img_path: the path to the board image
-    :param resizeing: int. the smaller image size for faster square identification. later it will
-                      be inflated, so use with caution. Also, this optional argument may be erased
-                      once this parameter is tuned.
+    :param resizeing: int. the detection resolution: the grid is found on the image resized to
+                      this size. The squares are cut from the full image at the session's
+                      square size (see board_squares).
     :param square_vis: number of square to be visualized
                        (to see that the inflation wasn't exaggerated). May be deleted afterwards.
+    :param session: the InferenceSession to classify with. Defaults to the process-wide session.
+    :param detection: the region detection mode, 'auto', 'grid' or 'ss' (see board_regions).
+    :param cache: optional cache.ResultCache. Repeated inputs skip detection and classification.
+    :param dedup: bool. classify only one of every group of near-identical squares.
+    :param stats: optional dict, filled with the square counts (see classify_squares).
+    :param progress: optional callable, called with the name of every stage ('regions',
+                     'inference', 'fen') before it starts. It may raise to abort the evaluation.
+    :param cascade: bool. label flat squares empty without the model (see classify_squares).
+    :param regions: optional 64 square rects on the resized image (see board_regions), e.g.
+                    fitted on an earlier snip of the same screen region. Skips the detection.
+    :param fitted: optional dict, filled with the 'regions' the squares were cut along (on the
+                   resized image), so they can be given back for the next image. On a cache
+                   hit they come from the cache, if it has them.
     """
-    model = ChessConvNet()
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
-    model.eval()
-
-    img = cv2.resize(img, (resizing, resizing))
-    regions = ss_regions(img, verbosity=False)
-    squares = regions2squares(img, regions, square_size=80)
-    if square_vis:
-        while True:
-            imOut = squares[square_vis].copy()
-            cv2.imshow("Output", imOut)
-
-            # record key press
-            k = cv2.waitKey(0) & 0xFF
-            # q is pressed
-            if k == 113:
-                break
-        # close image show window
-        cv2.destroyAllWindows()
-
-    pred_board = ['' for _ in range(64)]
-    idx = 0
-    ecount = 0
-    for i in range(64):
-        if i % 8 == 0 and i != 0:
-            pred_board[idx] = '/'
-            idx += 1
-
-        square = np.moveaxis(squares[i], -1, 0)
-        pred_square = model(torch.FloatTensor(square).unsqueeze(0))
-        pred_square = PIECES_DICT.get(LABELS_LIST[torch.argmax(pred_square, dim=1)])
-        if pred_square != 'e':
-            if ecount != 0:
-                pred_board[idx] = str(ecount)
-                idx += 1
-                ecount = 0
-            pred_board[idx] = pred_square
-            idx += 1
-        else:
-            ecount += 1
-            if i % 8 == 7:
-                pred_board[idx] = str(ecount)
-                idx += 1
-                ecount = 0
+    if session is None:
+        session = get_session(MODEL_PATH)
+    if progress is None:
+        progress = _no_progress
+
+    with span('evaluate', image=img.shape[:2], resizing=resizing) as root:
+        with span('resize', size=resizing):
+            resized = cv2.resize(img, (resizing, resizing))
+        if cache is not None:
+            key = cache.key(resized, session.fingerprint(), detection, img.shape)
+            entry = cache.get(key)
+            root.set(cache_hit=entry is not None)
+            if entry is not None:
+                if fitted is not None and entry.get('regions') is not None:
+                    fitted['regions'] = np.array(entry['regions'])
+                return entry['fen']
+
+        progress('regions')
+        if regions is None:
+            regions = board_regions(resized, mode=detection)
+        if fitted is not None:
+            fitted['regions'] = regions
+        squares = board_squares(img, resizing=resizing, square_size=session.square_size, detection=detection,
+                                channels=session.channels, regions=regions)
+        if square_vis:
+            while True:
+                imOut = np.moveaxis(squares[square_vis], 0, -1).copy()
+                cv2.imshow("Output", imOut)
+
+                # record key press
+                k = cv2.waitKey(0) & 0xFF
+                # q is pressed
+                if k == 113:
+                    break
+            # close image show window
+            cv2.destroyAllWindows()
+
+        # All the (unique) squares go through the model in a single forward pass
+        progress('inference')
+        labels = classify_squares(squares, session, dedup=dedup, stats=stats, cascade=cascade)
+        progress('fen')
+        with span('fen'):
+            fen = labels2fen(labels)
+        if cache is not None:
+            cache.put(key, fen, labels, regions)
+        return fen
+
+def evaluate_many(images, resizing=350, max_batch_size=None, session=None, detection='auto',
+                  dedup=True, stats=None, cascade=True):
+    """
+    Converts several boards at once. The squares of all the boards are concatenated and
+    classified together, in batches of at most max_batch_size squares.
+    :param images: iterable of board images (as accepted by evaluate).
+    :param max_batch_size: int. the maximal number of squares per forward pass. Defaults to the
+                           runtime profile's (see runtime.py).
+    :param detection: the region detection mode (see board_regions).
+    :param dedup: bool. classify only one of every group of near-identical squares, across boards.
+    :param stats: optional dict, filled with the square counts (see classify_squares).
+    :param cascade: bool. label flat squares empty without the model (see classify_squares).
+    :return: list of fens, one per image.
+    """
+    if session is None:
+        session = get_session(MODEL_PATH)
+    if max_batch_size is None:
+        max_batch_size = get_config()['max_batch_size']
+
+    with span('evaluate_many', resizing=resizing) as root:
+        squares = [board_squares(img, resizing=resizing, square_size=session.square_size, detection=detection,
+                                 channels=session.channels)
+                   for img in images]
+        root.set(boards=len(squares))
+        if not squares:
+            return []
+        labels = classify_squares(np.concatenate(squares), session, max_batch_size=max_batch_size,
+                                  dedup=dedup, stats=stats, cascade=cascade)
+        with span('fen', boards=len(squares)):
+            return [labels2fen(labels[64 * i: 64 * (i + 1)]) for i in range(len(squares))]
+
+def _cover_crossings(start, end, first, last):
+    """
+    Shifts the span [start, end] of a fitted board by whole squares so that it covers the
+    crossings found between first and last (give or take a quarter square).
+    :return: the shifted (start, end), or (None, None) if the crossings don't fit on the board.
+    """
+    square = (end - start) / 8
+    tolerance = square / 4
+    if first < start - tolerance:
+        shift = -np.ceil((start - first - tolerance) / square)
+    elif last > end + tolerance:
+        shift = np.ceil((last - end - tolerance) / square)
+    else:
+        return start, end
+    start, end = start + shift * square, end + shift * square
+    if first < start - tolerance or last > end + tolerance:
+        return None, None
+    return start, end
+
+def find_boards(page, max_side=1600, min_size=0.08, resizing=350):
+    """
+    Finds the boards on a page with several diagrams (e.g. a scanned book page).
+    Candidates are found on a copy of the page downscaled to at most max_side pixels, so the
+    memory stays bounded for large scans. Every roughly square blob of long straight edges is
+    a candidate, and it is kept if a grid can be fitted to it (see grid_regions).
+    :param page: BGR (or gray) image of the page.
+    :param min_size: the minimal board side, as a fraction of the page's shorter side.
+    :return: list of (x, y, w, h) bounding boxes in page coordinates, in reading order.
+    """
+    with span('find_boards', page=page.shape[:2]) as s:
+        height, width = page.shape[:2]
+        scale = min(1., max_side / max(height, width))
+        small = cv2.resize(page, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((3, 3), np.uint8))
+
+        # Rank and file boundaries are long straight edges, text is not: keep only the long
+        # horizontal and vertical strokes and join them into one blob per board. Text touching
+        # a board can still join its blob, but only the grid makes horizontal and vertical
+        # strokes cross, so the board is bounded by the crossings inside the blob
+        min_side = min_size * min(gray.shape)
+        length = max(3, int(min_side / 2))
+        horizontal = cv2.morphologyEx(edges, cv2.MORPH_OPEN, np.ones((1, length), np.uint8))
+        vertical = cv2.morphologyEx(edges, cv2.MORPH_OPEN, np.ones((length, 1), np.uint8))
+        crossings = horizontal & vertical
+        blobs = cv2.dilate(horizontal | vertical, np.ones((5, 5), np.uint8))
+        contours, _ = cv2.findContours(blobs, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        candidates = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if min(w, h) < min_side:
+                continue
+            ys, xs = np.nonzero(crossings[y:y + h, x:x + w])
+            if len(xs) == 0:
+                continue
+            x, y, w, h = x + xs.min(), y + ys.min(), xs.max() - xs.min() + 1, ys.max() - ys.min() + 1
+            if min(w, h) < min_side * 0.7 or abs(w - h) > 0.1 * max(w, h):
+                continue
+            # The outer border of light edge squares can blend into the page, so fit the grid
+            # on a crop with a margin and take the board from the fitted grid
+            margin = max(w, h) // 6
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(gray.shape[1], x + w + margin), min(gray.shape[0], y + h + margin)
+            crop = gray[y0:y1, x0:x1]
+            ratio = resizing / max(crop.shape)
+            rects, confidence = grid_regions(cv2.resize(crop, (int(round(crop.shape[1] * ratio)),
+                                                              int(round(crop.shape[0] * ratio)))),
+                                             return_confidence=True, check_bounds=False)
+            if confidence < GRID_MIN_CONFIDENCE:
+                continue
+            left, top = np.array([x0, y0]) + rects[0][:2] / ratio
+            right, bottom = np.array([x0, y0]) + (rects[63][:2] + rects[63][2:]) / ratio
+            # Strong text edges next to the board (e.g. a caption) can pull the fitted grid by
+            # whole squares. The crossings all lie on the board, so move the grid back over them
+            left, right = _cover_crossings(left, right, x, x + w)
+            top, bottom = _cover_crossings(top, bottom, y, y + h)
+            if left is None or top is None:
+                continue
+            candidates.append((left, top, right - left, bottom - top))
+        s.set(contours=len(contours), boards=len(candidates))
+
+    boxes = [tuple(int(round(v / scale)) for v in box) for box in candidates]
+    return _reading_order(boxes)
+
+def _reading_order(boxes):
+    """
+    Sorts boxes top to bottom by rows, then left to right. A box joins the current row if it
+    overlaps the row's first box vertically by more than half of the smaller height.
+    """
+    rows = []
+    for box in sorted(boxes, key=lambda box: box[1]):
+        if rows:
+            first = rows[-1][0]
+            overlap = min(first[1] + first[3], box[1] + box[3]) - max(first[1], box[1])
+            if overlap > min(first[3], box[3]) / 2:
+                rows[-1].append(box)
+                continue
+        rows.append([box])
+    return [box for row in rows for box in sorted(row, key=lambda box: box[0])]
+
+def evaluate_page(page, resizing=350, max_batch_size=None, session=None, detection='auto', dedup=True,
+                  stats=None, max_side=1600, cascade=True):
+    """
+    Converts every board on a page. The squares of all the boards are classified together.
+    :param page: BGR (or gray) image of the page.
+    :param max_side: the page is downscaled to at most this size to find the boards.
+    :return: list of {'fen': str, 'bbox': (x, y, w, h)}, one per board, in reading order.
+    """
+    if session is None:
+        session = get_session(MODEL_PATH)
+    if max_batch_size is None:
+        max_batch_size = get_config()['max_batch_size']
 
-    fen = ''.join(list(filter(None, pred_board)))
-    return fen
+    if page.ndim == 2:
+        page = cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
 
+    with span('evaluate_page', page=page.shape[:2]) as root:
+        boxes = find_boards(page, max_side=max_side, resizing=resizing)
+        root.set(boards=len(boxes))
+        if not boxes:
+            return []
+        squares = []
+        for x, y, w, h in boxes:
+            # Leave a small margin so the grid is fitted again on the whole board
+            margin = max(w, h) // 16
+            crop = page[max(0, y - margin):y + h + margin, max(0, x - margin):x + w + margin]
+            squares.append(board_squares(crop, resizing=resizing, square_size=session.square_size,
+                                         detection=detection, channels=session.channels))
+        labels = classify_squares(np.concatenate(squares), session, max_batch_size=max_batch_size,
+                                  dedup=dedup, stats=stats, cascade=cascade)
+        with span('fen', boards=len(boxes)):
+            return [{'fen': labels2fen(labels[64 * i: 64 * (i + 1)]), 'bbox': box} for i, box in enumerate(boxes)]
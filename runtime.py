@@ -0,0 +1,127 @@
+'''
+Runtime resource settings: the threads of OpenCV and torch, the number of worker processes
+and the number of squares per forward pass.
+
+The settings are read from a profile file, written by autotune.py for the host, and applied
+once per process when the pipeline is imported. Without a profile, one process uses all the
+cores, and worker pools split the cores between their workers so that they don't
+oversubscribe them. The profile path can be set with the SNIPCHESS_PROFILE environment
+variable.
+
+This module is cheap to import: torch and OpenCV are only imported when the settings are
+applied. The entry points (main.py, batch.py, server.py) import the recognition pipeline
+with preload() once they know they need it, so the tray icon or --help don't wait for torch.
+'''
+import importlib
+import json
+import os
+import threading
+from time import perf_counter
+
+
+MODEL_PATH = 'parameters.pt'
+BACKENDS = ('eager', 'torchscript', 'int8', 'onnx')
+# The modules behind a recognition, in import order
+PIPELINE_MODULES = ('numpy', 'cv2', 'torch', 'inference', 'png2fen')
+PROFILE_PATH = os.environ.get('SNIPCHESS_PROFILE', 'runtime_profile.json')
+SETTINGS = ('cv2_threads', 'torch_threads', 'torch_interop_threads', 'workers', 'worker_threads',
+            'max_batch_size')
+
+
+def default_config(cpus=None):
+    """
+    :param cpus: the number of cores to plan for. Defaults to the cores of the host.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    return {'cv2_threads': cpus, 'torch_threads': cpus, 'torch_interop_threads': None,
+            'workers': cpus, 'worker_threads': 1, 'max_batch_size': 256}
+
+
+def load_profile(path=PROFILE_PATH):
+    """
+    :return: the default config, updated with the settings of the profile file if it exists.
+    """
+    config = default_config()
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            profile = json.load(f)
+        config.update((k, v) for k, v in profile.get('settings', profile).items() if k in SETTINGS)
+    return config
+
+
+def save_profile(config, path=PROFILE_PATH, **extra):
+    """
+    Writes the settings (and anything in extra, e.g. the measurements) to the profile file.
+    """
+    profile = {'settings': {k: config[k] for k in SETTINGS}, **extra}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def apply_threads(cv2_threads=None, torch_threads=None, torch_interop_threads=None):
+    """
+    Sets the thread pools of OpenCV and torch. None leaves a library as it is.
+    """
+    if cv2_threads is not None:
+        import cv2
+        cv2.setNumThreads(cv2_threads)
+    if torch_threads is None and torch_interop_threads is None:
+        return
+    import torch
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    if torch_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(torch_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work
+            pass
+
+
+def apply_worker_threads(threads):
+    """
+    Initializes the threads of a worker process, which shares the host with the other workers.
+    """
+    apply_threads(cv2_threads=threads, torch_threads=threads)
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config(path=PROFILE_PATH):
+    """
+    Returns the process-wide config, loading the profile and applying its threads on first use.
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = load_profile(path)
+            apply_threads(_config['cv2_threads'], _config['torch_threads'], _config['torch_interop_threads'])
+        return _config
+
+
+_preloaded = set()
+_preload_lock = threading.Lock()
+
+
+def preload(modules=PIPELINE_MODULES):
+    """
+    Imports the recognition pipeline, e.g. on a background thread while the GUI is idle.
+    Imports are done once per process, so calling it again costs nothing. Threads that need
+    the pipeline must go through preload: two threads importing torch at the same time can
+    see it half initialized.
+    :return: {module name: seconds it took to import}
+    """
+    timings = {}
+    if _preloaded.issuperset(modules):
+        return timings
+    with _preload_lock:
+        for name in modules:
+            start = perf_counter()
+            importlib.import_module(name)
+            timings[name] = perf_counter() - start
+            _preloaded.add(name)
+    return timings
@@ -0,0 +1,203 @@
+'''
+A local recognition server with request micro-batching.
+
+Usage:
+    python server.py --port 8765 --max-batch 16 --max-wait 5
+
+    curl --data-binary @board.png http://127.0.0.1:8765/fen
+
+POST an encoded board image (png, jpg, ...) to /fen and get back {"fen": ...}. Boards that
+arrive within max-wait milliseconds of each other are classified together in a single
+ChessConvNet forward pass. GET /health reports the batching statistics.
+'''
+from runtime import BACKENDS, MODEL_PATH, preload
+from tracing import span
+
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+
+MAX_BODY_SIZE = 32 * 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    def __init__(self, session, executor, max_batch=16, max_wait=0.005):
+        """
+        :param max_batch: the maximal number of boards per forward pass.
+        :param max_wait: seconds to wait for more boards after the first one arrives.
+        """
+        self.session = session
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.boards = 0
+        self.stats = {}
+
+    async def classify(self, squares):
+        """
+        Queues the 64 squares of a board and waits for their fen.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((squares, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(pending) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            import numpy as np
+            from png2fen import classify_squares, labels2fen
+            batch = np.concatenate([squares for squares, _ in pending])
+            classify = partial(classify_squares, batch, self.session, stats=self.stats)
+            try:
+                labels = await loop.run_in_executor(self.executor, classify)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.boards += len(pending)
+            for i, (_, future) in enumerate(pending):
+                if not future.done():
+                    future.set_result(labels2fen(labels[64 * i: 64 * (i + 1)]))
+
+
+def decode_board(data, resizing, square_size, detection, channels=3):
+    import cv2
+    import numpy as np
+    from png2fen import board_squares
+    if not data:
+        raise ValueError('empty request body')
+    with span('decode', bytes=len(data)) as s:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('could not decode image')
+        s.set(image=img.shape[:2])
+    return board_squares(img, resizing=resizing, square_size=square_size, detection=detection,
+                         channels=channels)
+
+
+class RecognitionServer:
+    def __init__(self, session, max_batch=16, max_wait=0.005, resizing=350, detection='auto', workers=4):
+        self.session = session
+        self.executor = ThreadPoolExecutor(workers)
+        self.batcher = MicroBatcher(session, self.executor, max_batch=max_batch, max_wait=max_wait)
+        self.resizing = resizing
+        self.detection = detection
+
+    async def recognize(self, data):
+        loop = asyncio.get_running_loop()
+        start = time()
+        squares = await loop.run_in_executor(self.executor, decode_board, data, self.resizing,
+                                             self.session.square_size, self.detection, self.session.channels)
+        fen = await self.batcher.classify(squares)
+        return {'fen': fen, 'time': time() - start}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                status, body = 400, {'error': 'malformed request'}
+            elif request_line[1] == '/health':
+                status, body = 200, {'status': 'ok', 'batches': self.batcher.batches,
+                                     'boards': self.batcher.boards, **self.batcher.stats}
+            elif request_line[1] != '/fen':
+                status, body = 404, {'error': 'unknown path %s' % request_line[1]}
+            elif request_line[0] != 'POST':
+                status, body = 405, {'error': 'use POST with the image as the request body'}
+            else:
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status, body = 400, {'error': 'invalid Content-Length header'}
+                elif length > MAX_BODY_SIZE:
+                    status, body = 413, {'error': 'image is larger than %d bytes' % MAX_BODY_SIZE}
+                else:
+                    try:
+                        status, body = 200, await self.recognize(await reader.readexactly(length))
+                    except ValueError as e:
+                        status, body = 400, {'error': str(e)}
+                    except Exception as e:
+                        status, body = 500, {'error': '%s: %s' % (type(e).__name__, e)}
+
+            payload = json.dumps(body).encode()
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n'
+                          % (status, REASONS[status], len(payload))).encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving on http://%s:%d' % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.executor.shutdown(wait=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve board recognition over HTTP on localhost.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=16, help='maximal number of boards per forward pass')
+    parser.add_argument('--max-wait', type=float, default=5,
+                        help='milliseconds to wait for more boards before classifying a batch')
+    parser.add_argument('--workers', type=int, default=4, help='threads for decoding and inference')
+    parser.add_argument('--model', default=MODEL_PATH, help='path to the model parameters')
+    parser.add_argument('--backend', default='eager', choices=BACKENDS, help='inference backend')
+    parser.add_argument('--resizing', type=int, default=350, help='see png2fen.evaluate')
+    parser.add_argument('--detection', default='auto', choices=('auto', 'grid', 'ss'),
+                        help='region detection mode (see png2fen.board_regions)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The pipeline is only imported once the arguments are valid
+    preload()
+    from inference import get_session
+    server = RecognitionServer(get_session(args.model, args.backend), max_batch=args.max_batch,
+                               max_wait=args.max_wait / 1000, resizing=args.resizing,
+                               detection=args.detection, workers=args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
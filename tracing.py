@@ -0,0 +1,150 @@
+'''
+Structured tracing of the recognition pipeline.
+
+The pipeline records spans (decode, resize, regions, grid_fit, crop, inference, fen, ...)
+through the process-wide tracer. Tracing is disabled until a sink is added, and a disabled
+tracer hands out a shared no-op span, so the instrumentation costs one attribute check.
+
+    import tracing
+    ring = tracing.RingBufferSink(1000)
+    tracing.tracer.add_sink(ring)
+    evaluate(img)
+    for span in ring.spans(): print(span)
+
+A span is a dict with its name, trace id, parent span name, start time (unix seconds),
+duration (seconds) and the attributes set on it. Every sink is a callable taking a span.
+'''
+from collections import deque
+from itertools import count
+
+import json
+import threading
+from time import perf_counter, time
+
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if stack:
+            self.trace, self.parent = stack[-1].trace, stack[-1].name
+        else:
+            self.trace, self.parent = next(self.tracer._trace_ids), None
+        stack.append(self)
+        self.start = time()
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = perf_counter() - self._start
+        self.tracer._stack().pop()
+        record = {'name': self.name, 'trace': self.trace, 'parent': self.parent,
+                  'start': self.start, 'duration': duration, **self.attrs}
+        if exc_type is not None:
+            record['error'] = '%s: %s' % (exc_type.__name__, exc)
+        self.tracer.emit(record)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        self.sinks = []
+        self.enabled = False
+        self._local = threading.local()
+        self._trace_ids = count(1)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, **attrs):
+        """
+        Context manager timing a pipeline stage. Attributes can be passed here or set later
+        with span.set(...).
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attrs)
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink(record)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.enabled = True
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        self.enabled = bool(self.sinks)
+
+
+class RingBufferSink:
+    def __init__(self, maxlen=10000):
+        self._spans = deque(maxlen=maxlen)
+
+    def __call__(self, record):
+        self._spans.append(record)
+
+    def spans(self, name=None):
+        return [s for s in list(self._spans) if name is None or s['name'] == name]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CallbackSink:
+    def __init__(self, callback, names=None):
+        """
+        :param callback: called with every span record.
+        :param names: optional collection of span names to forward; None forwards all.
+        """
+        self.callback = callback
+        self.names = names
+
+    def __call__(self, record):
+        if self.names is None or record['name'] in self.names:
+            self.callback(record)
+
+
+tracer = Tracer()
+span = tracer.span
@@ -0,0 +1,284 @@
+'''
+Training and distillation of ChessConvNet on synthetic boards.
+
+Usage:
+    python train.py --variant small --teacher parameters.pt --steps 3000 --workers 4 -o small.pt
+
+Training data is generated on the fly. Worker processes render random positions with
+fen2png.DrawBoard on both themes, augment them (scale, blur, jpeg artifacts, colour shifts),
+cut them into squares the way png2fen.evaluate does and stream batches of labelled squares
+into training, so nothing but the final weights is written to disk.
+
+With --teacher, the student is distilled: it learns from the teacher's softened logits as
+well as from the labels, which lets a much smaller variant (see model.VARIANTS) keep the
+accuracy of the full model. The weights are saved as a plain state dict, which
+inference.InferenceSession loads like parameters.pt.
+'''
+from benchmark import fen2labels, random_fen
+from fen2png import DrawBoard
+from inference import MODEL_PATH, InferenceSession
+from model import VARIANTS, ChessConvNet
+from png2fen import regions2squares
+
+import argparse
+import cv2
+import numpy as np
+import sys
+import torch
+import torch.nn.functional as F
+from time import perf_counter, time
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+
+# Boards are rendered at a few square sizes only, so the sprites stay in fen2png's cache;
+# the scale augmentation covers the sizes in between
+RENDER_SQUARE_SIZES = (30, 40, 50, 60, 80, 100)
+
+
+def grid_rects(width, height):
+    """
+    The 64 square rects [x, y, w, h] of a board that fills a width x height image.
+    """
+    dx, dy = width / 8, height / 8
+    return np.array([[int(round(dx * j)), int(round(dy * i)), int(round(dx)), int(round(dy))]
+                     for i in range(8) for j in range(8)])
+
+
+def augment(img, rng):
+    """
+    Makes a rendered board look like a snip: a random scale, blur, jpeg artifacts and a
+    colour and brightness shift, each applied with some probability.
+    :param img: BGR board image.
+    :param rng: numpy RandomState.
+    """
+    height, width = img.shape[:2]
+    if rng.random_sample() < 0.7:
+        scale = rng.uniform(0.4, 1.5)
+        img = cv2.resize(img, (max(16, int(width * scale)), max(16, int(height * scale))),
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    if rng.random_sample() < 0.3:
+        img = cv2.GaussianBlur(img, (0, 0), rng.uniform(0.3, 1.5))
+    if rng.random_sample() < 0.5:
+        gain = rng.uniform(0.8, 1.2, size=3)
+        bias = rng.uniform(-25, 25, size=3) + rng.uniform(-20, 20)
+        img = np.clip(img * gain + bias, 0, 255).astype(np.uint8)
+    if rng.random_sample() < 0.4:
+        _, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, int(rng.randint(20, 95))])
+        img = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    return img
+
+
+def make_batch(rng, boards=8, square_size=80, resizing=350, augmentation=True, jitter=2, channels=1):
+    """
+    Renders random boards and cuts them into labelled squares.
+    :param boards: number of boards, the batch holds 64 squares per board.
+    :param jitter: the board edges are moved by up to this many pixels at the detection
+                   resolution (resizing), like a slightly off grid detection. The squares are
+                   cut from the full resolution board, as png2fen.board_squares does.
+    :param channels: the channels of the gray squares (see png2fen.regions2squares).
+    :return: (uint8 array [64 * boards, channels, square_size, square_size], int64 array [64 * boards])
+    """
+    squares = np.empty((64 * boards, channels, square_size, square_size), dtype=np.uint8)
+    labels = np.empty(64 * boards, dtype=np.int64)
+    for i in range(boards):
+        fen = random_fen(rng)
+        render_size = int(rng.choice(RENDER_SQUARE_SIZES))
+        img = DrawBoard(fen, boardtype='wb'[rng.randint(2)], square_size=render_size).boardArray()
+        if augmentation:
+            img = augment(img, rng)
+        height, width = img.shape[:2]
+        left, top, right, bottom = np.round(rng.randint(0, jitter + 1, size=4) * width / resizing).astype(int)
+        img = img[top:height - bottom, left:width - right]
+        squares[64 * i: 64 * (i + 1)] = regions2squares(img, grid_rects(img.shape[1], img.shape[0]),
+                                                        square_size=square_size, channels=channels)
+        labels[64 * i: 64 * (i + 1)] = fen2labels(fen)
+    return squares, labels
+
+
+class SquareStream(IterableDataset):
+    def __init__(self, boards=8, square_size=80, resizing=350, augmentation=True, seed=0, channels=1):
+        """
+        An endless stream of make_batch batches. Every DataLoader worker gets its own seed.
+        """
+        self.boards = boards
+        self.square_size = square_size
+        self.resizing = resizing
+        self.augmentation = augmentation
+        self.seed = seed
+        self.channels = channels
+
+    def __iter__(self):
+        worker = get_worker_info()
+        rng = np.random.RandomState([self.seed, worker.id if worker is not None else 0])
+        while True:
+            yield make_batch(rng, self.boards, self.square_size, self.resizing, self.augmentation,
+                             channels=self.channels)
+
+
+def _init_worker(worker_id):
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+
+
+def stream_loader(stream, workers=4):
+    """
+    Streams the batches of a SquareStream, generated by the given number of worker processes
+    (0 generates them in the training process).
+    """
+    return DataLoader(stream, batch_size=None, num_workers=workers, worker_init_fn=_init_worker,
+                      prefetch_factor=4 if workers else None, persistent_workers=workers > 0)
+
+
+def distillation_loss(logits, labels, teacher_logits=None, temperature=4., alpha=0.7):
+    """
+    Cross entropy with the labels, mixed with the KL divergence to the teacher's softened
+    distribution when teacher logits are given.
+    :param alpha: the weight of the teacher term.
+    """
+    hard = F.cross_entropy(logits, labels)
+    if teacher_logits is None:
+        return hard
+    soft = F.kl_div(F.log_softmax(logits / temperature, dim=1), F.softmax(teacher_logits / temperature, dim=1),
+                    reduction='batchmean') * temperature ** 2
+    return alpha * soft + (1 - alpha) * hard
+
+
+def fit_squares(batch, square_size):
+    """
+    Resizes a float batch of squares to square_size, e.g. for a teacher trained at another size.
+    """
+    if batch.shape[-1] == square_size:
+        return batch
+    return F.interpolate(batch, size=square_size, mode='bilinear', align_corners=False)
+
+
+def accuracy(model, squares, labels, batch_size=512):
+    """
+    :return: (square accuracy, board accuracy) of the model on the squares, 64 per board.
+    """
+    model.eval()
+    with torch.inference_mode():
+        predicted = torch.cat([model(fit_squares(torch.from_numpy(squares[i:i + batch_size]).float(),
+                                                 model.square_size)).argmax(1)
+                               for i in range(0, len(squares), batch_size)]).numpy()
+    hits = (predicted == labels).reshape(-1, 64)
+    return float(hits.mean()), float(hits.all(axis=1).mean())
+
+
+def board_latency(model, square_size, repeats=20):
+    """
+    :return: the median time in seconds of a forward pass over one board (64 squares).
+    """
+    model.eval()
+    batch = torch.zeros(64, model.in_channels, square_size, square_size)
+    times = []
+    with torch.inference_mode():
+        for _ in range(repeats):
+            start = perf_counter()
+            model(batch)
+            times.append(perf_counter() - start)
+    return float(np.median(times))
+
+
+def train(student, loader, steps=3000, lr=1e-3, teacher=None, temperature=4., alpha=0.7,
+          validation=None, eval_every=250, log=None):
+    """
+    Trains the student on the streamed batches.
+    :param teacher: optional model to distill from (kept frozen). Its squares are resized to
+                    its own square size when it differs from the student's.
+    :param validation: optional (squares, labels); the weights with the best square accuracy
+                       are kept.
+    :param log: optional callable taking a line of progress.
+    :return: the best square accuracy on the validation set (None without one).
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, steps)
+    if teacher is not None:
+        teacher.eval()
+    best_accuracy, best_state = None, None
+    start = time()
+    for step, (squares, labels) in enumerate(loader, 1):
+        batch = squares.float()
+        teacher_logits = None
+        if teacher is not None:
+            with torch.inference_mode():
+                teacher_logits = teacher(fit_squares(batch, teacher.square_size))
+        student.train()
+        loss = distillation_loss(student(batch), labels, teacher_logits, temperature, alpha)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+
+        if validation is not None and (step % eval_every == 0 or step == steps):
+            square_accuracy, board_accuracy = accuracy(student, *validation)
+            if best_accuracy is None or square_accuracy > best_accuracy:
+                best_accuracy = square_accuracy
+                best_state = {k: v.clone() for k, v in student.state_dict().items()}
+            if log is not None:
+                log('step %d, loss %.4f, square accuracy %.4f, board accuracy %.3f, %.0f s'
+                    % (step, loss.item(), square_accuracy, board_accuracy, time() - start))
+        if step >= steps:
+            break
+
+    if best_state is not None:
+        student.load_state_dict(best_state)
+    return best_accuracy
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Train or distill ChessConvNet on synthetic boards.')
+    parser.add_argument('--variant', default='small', choices=sorted(VARIANTS), help='student architecture')
+    parser.add_argument('--teacher', default=None, help='parameters of a model to distill from, e.g. '
+                                                        + MODEL_PATH)
+    parser.add_argument('--init', default=None, help='parameters to start the student from')
+    parser.add_argument('--square-size', type=int, default=80)
+    parser.add_argument('--in-channels', type=int, default=1, choices=(1, 3),
+                        help='1 for a native gray model, 3 for gray stacked into three channels')
+    parser.add_argument('--resizing', type=int, default=350, help='see png2fen.evaluate')
+    parser.add_argument('--steps', type=int, default=3000)
+    parser.add_argument('--boards', type=int, default=8, help='boards per batch (64 squares each)')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=4.)
+    parser.add_argument('--alpha', type=float, default=0.7, help='weight of the teacher term of the loss')
+    parser.add_argument('--workers', type=int, default=4, help='processes generating the training data')
+    parser.add_argument('--validation-boards', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', required=True, help='where to save the student parameters')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    torch.manual_seed(args.seed)
+    student = ChessConvNet(square_size=args.square_size, in_channels=args.in_channels, **VARIANTS[args.variant])
+    if args.init:
+        student.load_state_dict(torch.load(args.init, map_location=torch.device('cpu')))
+    teacher = None
+    if args.teacher:
+        teacher = InferenceSession(args.teacher, grayscale=args.in_channels == 1).model
+
+    # The validation boards come from a seed the stream never uses
+    validation = make_batch(np.random.RandomState([args.seed, 2 ** 31 - 1]), args.validation_boards,
+                            args.square_size, args.resizing, channels=args.in_channels)
+    loader = stream_loader(SquareStream(args.boards, args.square_size, args.resizing, seed=args.seed,
+                                        channels=args.in_channels),
+                           workers=args.workers)
+
+    def log(line):
+        print(line, file=sys.stderr)
+
+    if teacher is not None:
+        log('teacher: square accuracy %.4f, board accuracy %.3f' % accuracy(teacher, *validation))
+    train(student, loader, steps=args.steps, lr=args.lr, teacher=teacher, temperature=args.temperature,
+          alpha=args.alpha, validation=validation, log=log)
+    torch.save(student.state_dict(), args.output)
+
+    square_accuracy, board_accuracy = accuracy(student, *validation)
+    log('%s: %d parameters, %.2f ms per board, square accuracy %.4f, board accuracy %.3f' % (
+        args.variant, sum(p.numel() for p in student.parameters()),
+        1000 * board_latency(student, args.square_size), square_accuracy, board_accuracy))
+
+
+if __name__ == '__main__':
+    main()
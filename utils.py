@@ -1,76 +1,84 @@
 import PyQt5
-import numpy as np
-import cv2
+from functools import lru_cache
 
-from PyQt5.QtCore import QRect, Qt, pyqtSignal
-from PyQt5.QtGui import QColor, QCursor, QIcon, QMouseEvent, QPainter, QPainterPath, QPixmap
+from PyQt5.QtCore import QObject, QRect, QRunnable, Qt, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QCursor, QIcon, QImage, QMouseEvent, QPainter, QPainterPath, QPixmap
 from PyQt5.QtWidgets import QApplication, QDialog, QLabel
 
-from png2fen import evaluate
-from fen2png import DrawBoard, is_int
+from board import Board
+from runtime import PIPELINE_MODULES, preload
 
+# Only Qt is imported with the GUI. numpy, OpenCV, torch and the pipeline modules are imported
+# where they are first needed, and PrewarmTask imports them in the background at startup.
+# They are always imported through runtime.preload, which keeps threads from importing them
+# at the same time.
+PRELOAD_MODULES = PIPELINE_MODULES + ('cache', 'fen2png', 'watch')
 
-def pixmap2array(pixmap):
-    channels = 4
-    image = pixmap.toImage()
-    height = pixmap.size().height()
-    width = pixmap.size().width()
-    s = image.bits().asstring(width * height * channels)
-    arr = np.fromstring(s, dtype=np.uint8).reshape((height, width, channels)) 
 
+@lru_cache(maxsize=None)
+def _qimage_array_type():
+    preload(('numpy',))
+    import numpy as np
+
+    class QImageArray(np.ndarray):
+        """
+        A numpy view of a QImage's pixels. It holds a reference to the image, so the buffer stays
+        valid for as long as the array (or any view of it) is alive.
+        """
+        qimage = None
+
+    return QImageArray
+
+
+def qimage2array(image):
+    """
+    Wraps the pixels of a QImage as a [height, width, 4] BGRA uint8 array without copying.
+    Rows are addressed with the image's bytesPerLine, so padded scanlines are handled. Images
+    that are not 32 bits per pixel are converted first.
+    """
+    preload(('numpy',))
+    import numpy as np
+    if image.isNull():
+        raise ValueError('cannot convert a null image')
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied):
+        image = image.convertToFormat(QImage.Format_RGB32)
+    buffer = image.constBits()
+    buffer.setsize(image.bytesPerLine() * image.height())
+    arr = np.ndarray(shape=(image.height(), image.width(), 4), dtype=np.uint8, buffer=buffer,
+                     strides=(image.bytesPerLine(), 4, 1)).view(_qimage_array_type())
+    arr.qimage = image
     return arr
 
+def pixmap2array(pixmap):
+    return qimage2array(pixmap.toImage())
+
+def grabScreenRect(rect):
+    """
+    Grabs a region of the screen that holds its center, as a QPixmap.
+    :param rect: QRect in global (desktop) coordinates.
+    """
+    screen = QApplication.screenAt(rect.center()) or QApplication.primaryScreen()
+    offset = rect.topLeft() - screen.geometry().topLeft()
+    return screen.grabWindow(0, offset.x(), offset.y(), rect.width(), rect.height())
+
 def extend_fen(fen):
     """
     extends a fen name to be 8 characters long for each row, for easy counting.
     :param fen_list: list of strings where each string represents a rank position
     """
-    for i in range(8):
-        jdx = 0
-        for _ in range(len(fen[i])):
-            if is_int(fen[i][jdx]):
-                nempty = int(fen[i][jdx])
-                fen[i] = fen[i][:jdx] + 'e' * nempty + fen[i][jdx + 1:]
-                jdx += nempty
-                continue
-            jdx += 1
+    fen[:] = Board.from_fen('/'.join(fen)).extended().split('/')
     return fen
 
 def compress_fen(extended_fen):
-    compressed_fen = []
-    fen_ranks = extended_fen.split('/')
-    for rank in fen_ranks:
-        compressed_rank = ''
-        ecount = 0
-        for j, square in enumerate(rank):
-            if square != 'e':
-                if ecount != 0:
-                    compressed_rank += str(ecount)
-                    ecount = 0
-                compressed_rank += square                    
-                continue
-            ecount += 1
-            if j == 7:
-                compressed_rank += str(ecount)
-        compressed_fen.append(compressed_rank)
-
-    return '/'.join(list(filter(None, compressed_fen)))
+    return Board(extended_fen.replace('/', '').encode()).to_fen()
 
 def flip_fen(fen):
     tmp_fen = fen.split()
-    fen_position = tmp_fen[0].split('/')[::-1]
-    return ' '.join(['/'.join(fen_position), *tmp_fen[1:]])
+    return ' '.join([Board.from_fen(tmp_fen[0]).flipped().to_fen(), *tmp_fen[1:]])
 
 def square_extended_fen_position(square_size, x, y):
-    file = None
-    rank = None
-    for i in range(8):
-        if x in range(square_size * i, square_size * (i + 1)):
-            file = i
-        if y in range(square_size * i, square_size * (i + 1)):
-            rank = i
-        if file and rank:
-            break
+    file = int(x) // square_size if 0 <= x < 8 * square_size else None
+    rank = int(y) // square_size if 0 <= y < 8 * square_size else None
     return (file, rank)
 
 
@@ -84,10 +92,10 @@ class SnippingTool(QDialog):
         self.setWindowState(Qt.WindowState.WindowActive)
         self.setGeometry(QApplication.desktop().geometry())
 
-        self.dekstopPixmap = self.grabScreenshot()
+        self.screenPixmaps = self.grabScreenshot()
         self.selectedRect = QRect()
 
-        self.fen = None
+        self.selectedArray = None
 
     def mousePressEvent(self, event):
         self.selectedRect.setTopLeft(event.globalPos())
@@ -97,14 +105,17 @@ class SnippingTool(QDialog):
         self.update()
 
     def mouseReleaseEvent(self, event):
-        self.selectedPixmap = self.dekstopPixmap.copy(self.selectedRect.normalized())
+        self.selectedPixmap = self.grabRegion(self.selectedRect.normalized())
+        if self.selectedPixmap.isNull():
+            self.reject()
+            return
+        self.selectedArray = pixmap2array(self.selectedPixmap)
         self.accept()
 
-        self.fen = evaluate(pixmap2array(self.selectedPixmap), resizing=450)
-
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.drawPixmap(0, 0, self.dekstopPixmap)
+        for geometry, pixmap in self.screenPixmaps:
+            painter.drawPixmap(geometry.topLeft(), pixmap)
 
         path = QPainterPath()
         path.addRect(*self.selectedRect.getRect())
@@ -116,27 +127,254 @@ class SnippingTool(QDialog):
 
     @staticmethod
     def grabScreenshot():
-        desktopPixmap = QPixmap(QApplication.desktop().geometry().size())
-        painter = QPainter(desktopPixmap)
-        for screen in QApplication.screens():
-            painter.drawPixmap(screen.geometry().topLeft(), screen.grabWindow(0))
+        """
+        :return: list of (screen geometry, screen pixmap). The screens are not composited into a
+                 desktop-sized pixmap; only the selected region is assembled (see grabRegion).
+        """
+        return [(screen.geometry(), screen.grabWindow(0)) for screen in QApplication.screens()]
+
+    def grabRegion(self, rect):
+        """
+        Assembles the selected region from the screens it overlaps.
+        """
+        overlapping = [(geometry, pixmap) for geometry, pixmap in self.screenPixmaps if geometry.intersects(rect)]
+        if len(overlapping) == 1 and overlapping[0][0].contains(rect):
+            geometry, pixmap = overlapping[0]
+            return pixmap.copy(rect.translated(-geometry.topLeft()))
+
+        regionPixmap = QPixmap(rect.size())
+        regionPixmap.fill(Qt.black)
+        painter = QPainter(regionPixmap)
+        for geometry, pixmap in overlapping:
+            part = geometry.intersected(rect)
+            painter.drawPixmap(part.topLeft() - rect.topLeft(), pixmap, part.translated(-geometry.topLeft()))
+        painter.end()
+        return regionPixmap
+
+
+class ScreenWatcher(QObject):
+    """
+    Grabs a fixed screen region every `interval` milliseconds and emits fenChanged whenever
+    the position on it changes (see watch.BoardWatcher). The frames are recognized on the
+    QThreadPool; ticks that come while a frame is still being recognized are skipped.
+    """
+    fenChanged = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, rect, interval=500, resizing=450):
+        super().__init__()
+        self.rect = rect
+        self.interval = interval
+        self.resizing = resizing
+        self.watcher = None
+        self.frameTask = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.grabFrame)
+
+    def start(self):
+        # A frame still in flight keeps the old watcher; its result is ignored
+        self.watcher = None
+        self.frameTask = None
+        self.timer.start(self.interval)
+
+    def stop(self):
+        self.timer.stop()
+        self.frameTask = None
+
+    def grabFrame(self):
+        if self.frameTask is not None:
+            return
+        self.frameTask = WatchFrameTask(self.watcher, pixmap2array(grabScreenRect(self.rect)), self.resizing)
+        self.frameTask.signals.finished.connect(self.frameFinished)
+        self.frameTask.signals.failed.connect(self.frameFailed)
+        QThreadPool.globalInstance().start(self.frameTask)
+
+    def isCurrentFrame(self):
+        return self.frameTask is not None and self.sender() is self.frameTask.signals
+
+    def frameFinished(self, fen):
+        if not self.isCurrentFrame():
+            return
+        self.watcher = self.frameTask.watcher
+        self.frameTask = None
+        if fen:
+            self.fenChanged.emit(fen)
+
+    def frameFailed(self, error):
+        if not self.isCurrentFrame():
+            return
+        self.stop()
+        self.failed.emit(error)
+
+
+class Cancelled(Exception):
+    pass
+
 
-        return desktopPixmap
+class TaskSignals(QObject):
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class RecognitionTask(QRunnable):
+    """
+    Runs png2fen.evaluate on a QThreadPool thread. Connect to self.signals before starting it;
+    they are delivered on the GUI thread. Once finished, self.regions holds the fitted grid, which
+    can be given to the task of the next snip of the same screen rect to skip the detection.
+    """
+    STAGES = {'regions': 'Locating the board...', 'inference': 'Recognizing the pieces...', 'fen': 'Writing the FEN...'}
+
+    def __init__(self, image, resizing=450, regions=None):
+        super().__init__()
+        self.image = image
+        self.resizing = resizing
+        self.regions = regions
+        self.signals = TaskSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Stops the recognition at the next stage boundary; self.signals.cancelled is emitted instead of finished.
+        """
+        self._cancelled = True
+
+    def _progress(self, stage):
+        if self._cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(list(self.STAGES).index(stage) + 1, self.STAGES[stage])
+
+    def run(self):
+        try:
+            preload(PRELOAD_MODULES)
+            from cache import get_cache
+            from png2fen import evaluate
+            fitted = {}
+            fen = evaluate(self.image, resizing=self.resizing, cache=get_cache(), progress=self._progress,
+                           regions=self.regions, fitted=fitted)
+            self.regions = fitted.get('regions', self.regions)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.failed.emit('%s: %s' % (type(e).__name__, e))
+        else:
+            if self._cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(fen)
+
+
+class WatchFrameTask(QRunnable):
+    """
+    Runs BoardWatcher.update on a frame on a QThreadPool thread. Emits finished with the new fen,
+    or an empty string if the position didn't change.
+    :param watcher: the BoardWatcher of the previous frames, None to start a new one.
+    """
+    def __init__(self, watcher, frame, resizing=450):
+        super().__init__()
+        self.watcher = watcher
+        self.frame = frame
+        self.resizing = resizing
+        self.signals = TaskSignals()
+
+    def run(self):
+        try:
+            preload(PRELOAD_MODULES)
+            from watch import BoardWatcher
+            if self.watcher is None:
+                self.watcher = BoardWatcher(resizing=self.resizing)
+            fen = self.watcher.update(self.frame)
+        except Exception as e:
+            self.signals.failed.emit('%s: %s' % (type(e).__name__, e))
+        else:
+            self.signals.finished.emit(fen or '')
+
+
+class PrewarmTask(QRunnable):
+    """
+    Imports the pipeline, loads the model and runs one forward pass in the background, so that
+    neither the startup nor the first snip pays for them. Emits finished with the import times.
+    """
+    def __init__(self):
+        super().__init__()
+        self.signals = TaskSignals()
+
+    def run(self):
+        try:
+            timings = preload(PRELOAD_MODULES)
+            import numpy as np
+            from inference import get_session
+            session = get_session()
+            session.predict(np.zeros([1, session.channels, session.square_size, session.square_size],
+                                     dtype=np.uint8))
+        except Exception as e:
+            self.signals.failed.emit('%s: %s' % (type(e).__name__, e))
+        else:
+            self.signals.finished.emit(', '.join('%s %.0f ms' % (name, 1000 * seconds)
+                                                 for name, seconds in timings.items()))
 
 
 class BoardWidget(QLabel):
     rightClick = pyqtSignal(float, float, QMouseEvent)
 
-    def __init__(self, currentFen, squareSize=40, dark=True):
+    # Empty boards and piece sprites, shared by all the widgets
+    _backgrounds = {}
+    _pieces = {}
+
+    def __init__(self, currentFen, squareSize=40, dark=True, boardType='w'):
         self.squareSize = squareSize
+        self.dark = dark
         super().__init__()
 
-        board = DrawBoard(currentFen, square_size=self.squareSize)
-        self.boardPixmap = board.boardQPixmap(dark)
-        self.setPixmap(self.boardPixmap)
+        self.boardType = None
+        self.board = None
+        self.setPosition(currentFen, boardType)
         self.setAlignment(Qt.AlignHCenter)
 
-        
+    def _background(self, boardType):
+        key = (boardType, self.squareSize, self.dark)
+        if key not in self._backgrounds:
+            preload(('fen2png',))
+            from fen2png import DrawBoard
+            board = DrawBoard('8/8/8/8/8/8/8/8', boardtype=boardType, square_size=self.squareSize)
+            self._backgrounds[key] = board.boardQPixmap(self.dark)
+        return self._backgrounds[key]
+
+    def _piece(self, piece):
+        key = (piece, self.squareSize, self.dark)
+        if key not in self._pieces:
+            preload(('fen2png',))
+            from fen2png import pieceQPixmap
+            self._pieces[key] = pieceQPixmap(piece, self.squareSize, self.dark)
+        return self._pieces[key]
+
+    def setPosition(self, fen, boardType='w'):
+        """
+        Shows the position, repainting only the squares that changed. A new board type
+        repaints the cached empty board and the pieces on it.
+        :param fen: the position as drawn, top rank first (i.e. already flipped for black's perspective).
+        """
+        board = Board.from_fen(fen)
+        if boardType != self.boardType:
+            self.boardType = boardType
+            self.boardPixmap = QPixmap(self._background(boardType))
+            changed = [i for i in range(64) if board[i]]
+        else:
+            changed = [i for i in range(64) if board.cells[i] != self.board.cells[i]]
+        self.board = board
+
+        if changed:
+            background = self._background(boardType)
+            painter = QPainter(self.boardPixmap)
+            for i in changed:
+                square = QRect((i % 8) * self.squareSize, (i // 8) * self.squareSize,
+                               self.squareSize, self.squareSize)
+                painter.drawPixmap(square, background, square)
+                if board[i]:
+                    painter.drawPixmap(square.topLeft(), self._piece(board[i]))
+            painter.end()
+        self.setPixmap(self.boardPixmap)
 
     def mousePressEvent(self, event):
         if event.button() == Qt.RightButton:
@@ -0,0 +1,85 @@
+'''
+Live recognition of a board that changes over time, e.g. a broadcast on screen.
+
+The grid is located once, on the first frame, and kept for the whole session. Every later
+frame is cut into squares along the same grid and compared square by square against the
+squares that were last classified. Only the squares that changed go through the model,
+and a frame that is byte-for-byte identical to the previous one costs a single comparison.
+'''
+from inference import MODEL_PATH, get_session
+from png2fen import board_regions, classify_squares, labels2fen, regions2squares, scale_regions
+from tracing import span
+
+import cv2
+import numpy as np
+
+
+class BoardWatcher:
+    def __init__(self, session=None, resizing=450, detection='auto', threshold=6.):
+        """
+        :param session: the InferenceSession to classify with. Defaults to the process-wide
+                        session, loaded on the first frame.
+        :param resizing: size the first frame is resized to for locating the grid. The squares
+                         are cut from the full frames.
+        :param detection: the region detection mode for the first frame (see png2fen.board_regions).
+        :param threshold: mean absolute pixel difference above which a square counts as changed.
+        """
+        self.session = session
+        self.resizing = resizing
+        self.detection = detection
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the grid and the position; the next frame is recognized from scratch.
+        """
+        self.regions = None
+        self.frame = None
+        self.squares = None
+        self.labels = None
+        self.fen = None
+        self.frames = 0
+        self.classified_squares = 0
+
+    def update(self, img):
+        """
+        :param img: the current frame of the watched region (BGR or BGRA).
+        :return: the new fen if the position changed, otherwise None.
+        """
+        self.frames += 1
+        if self.session is None:
+            self.session = get_session(MODEL_PATH)
+        if self.frame is not None and self.frame.shape == img.shape and np.array_equal(self.frame, img):
+            return None
+        self.frame = np.array(img)
+
+        with span('watch_frame', frame=self.frames) as s:
+            if self.regions is None:
+                resized = cv2.resize(img, (self.resizing, self.resizing))
+                self.regions = board_regions(resized, mode=self.detection)
+            squares = regions2squares(img, scale_regions(self.regions, img.shape, self.resizing),
+                                      square_size=self.session.square_size, channels=self.session.channels)
+
+            if self.squares is None:
+                changed = np.arange(64)
+                self.squares = squares.copy()
+                self.labels = np.zeros(64, dtype=np.int64)
+            else:
+                diff = np.abs(squares.astype(np.int16) - self.squares).mean(axis=(1, 2, 3))
+                changed = np.flatnonzero(diff > self.threshold)
+            s.set(changed_squares=len(changed))
+            if len(changed) == 0:
+                return None
+
+            # Compare later frames with the squares as they were classified, so slow drifts
+            # still add up to a change
+            self.squares[changed] = squares[changed]
+            self.labels[changed] = classify_squares(squares[changed], self.session)
+            self.classified_squares += len(changed)
+
+        fen = labels2fen(self.labels)
+        if fen == self.fen:
+            return None
+        self.fen = fen
+        return fen